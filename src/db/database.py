@@ -6,8 +6,12 @@ import json
 import logging
 
 from db.sqlite_utils import get_literals
+from query.canonical_cache import CanonicalCache
+from query.sample_store import SampleStore
+from query.sql_memo import SqlMemo
+from query.word_tokenizer import tokenize_spider_sql
 from spider import process_sql
-from spider.parse_raw_json import get_schemas_from_json, Schema as SpiderSchema
+from spider.parse_raw_json import Schema as SpiderSchema
 
 
 class Database:
@@ -18,13 +22,25 @@ class Database:
         directory: location of sqlite file
         schema: DB schema
         tables_file: location of the spider tables.json file
+        db_info: entry of the DB in the spider tables.json file
         sqlite: location of the sqlite file
         literals: values that occur in the DB
         spider_schema:
         umich_schema:
+        CanonicalCache canonical_cache: canonical forms and spider labels of the query skeletons on this DB
+        SqlMemo sql_memo: SQL side of the queries output for the current template line
+        SampleStore sample_store: interned SQL records of the generated samples
     """
 
-    def __init__(self, db, db_directory, schema, tables_file):
+    def __init__(self, db, db_directory, schema, tables_file, tables=None, canonical_cache_size=10000):
+        """
+        :param str db: name of the DB
+        :param str db_directory: location of sqlite file
+        :param Schema schema: DB schema
+        :param str tables_file: location of the spider tables.json file
+        :param list tables: content of the tables.json file, read from tables_file if not provided
+        :param int canonical_cache_size: maximum number of cached query skeletons, 0 to disable the cache
+        """
         self.name = db
         self.directory = db_directory
         self.schema = schema
@@ -36,10 +52,17 @@ class Database:
 
         self.sqlite = db_files[0]
 
+        if tables is None:
+            with open(self.tables_file) as open_file:
+                tables = json.load(open_file)
+        self.db_info = next((i for i in tables if i['db_id'] == self.name))
+
         self.literals = self.get_column_values()
-        schemas, db_names, tables = get_schemas_from_json(self.tables_file)
-        self.spider_schema = SpiderSchema(schemas[self.name], tables[self.name])
+        self.spider_schema = self.make_spider()
         self.umich_schema = self.make_umich()
+        self.canonical_cache = CanonicalCache(canonical_cache_size)
+        self.sql_memo = SqlMemo()
+        self.sample_store = SampleStore()
 
     def get_column_values(self):
         """
@@ -63,6 +86,22 @@ class Database:
 
         return value_dict
 
+    def make_spider(self):
+        """
+        create schema for parsing queries into the spider format, as in spider's get_schemas_from_json
+
+        :return SpiderSchema: schema mapping tables and columns to identifiers
+        """
+
+        column_names_original = self.db_info['column_names_original']
+        table_names_original = self.db_info['table_names_original']
+
+        schema = {str(table.lower()): [str(col.lower()) for table_id, col in column_names_original if table_id == i]
+                  for i, table in enumerate(table_names_original)}
+        table = {'column_names_original': column_names_original, 'table_names_original': table_names_original}
+
+        return SpiderSchema(schema, table)
+
     def make_umich(self):
         """
         create schema for canonicalisation
@@ -70,10 +109,7 @@ class Database:
         :return tuple: dict of all fields of a table, set of all names of tables and fields
         """
 
-        with open(self.tables_file) as open_file:
-            schema_info = json.load(open_file)
-
-        db = next((i for i in schema_info if i['db_id'] == self.name))
+        db = self.db_info
         all_words = set()
         table_field_map = {}
 
@@ -96,4 +132,8 @@ class Database:
         :param str sql: complete sql query as a string
         :return dict: processed sql
         """
-        return process_sql.get_sql(self.spider_schema, sql)
+        # process_sql.get_sql with the fast tokenizer
+        tokens = tokenize_spider_sql(sql)
+        tables_with_alias = process_sql.get_tables_with_alias(self.spider_schema.schema, tokens)
+        _, parsed = process_sql.parse_sql(tokens, 0, tables_with_alias, self.spider_schema)
+        return parsed
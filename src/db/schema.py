@@ -1,11 +1,37 @@
 # coding=utf-8
 """ Schema class
 """
-from collections import OrderedDict
+import re
+from collections import OrderedDict, deque
 
 import commentjson
 
 
+class JoinPath:
+    """
+    shortest path of foreign keys between two tables with its joins rendered
+
+    Attributes:
+        list tables: tables along the path, from the first to the last table
+        list columns: pair of linked columns for each step, e.g. (singer.singer_id, singer_in_concert.singer_id)
+        list conditions: join condition for each step of the path
+        str join_from: joined tables for a FROM clause
+        str join_where: join conditions for a WHERE clause
+    """
+
+    def __init__(self, tables, links):
+        """
+        :param list tables: tables along the path
+        :param dict links: linking column of a table by linked table
+        """
+        self.tables = tables
+        self.columns = [(f'{table1}.{links[table1][table2]}', f'{table2}.{links[table2][table1]}')
+                        for table1, table2 in zip(tables, tables[1:])]
+        self.conditions = [f'{column1} = {column2}' for column1, column2 in self.columns]
+        self.join_from = ' JOIN '.join(tables)
+        self.join_where = ' AND '.join(self.conditions)
+
+
 class Schema:
     """
     class representing a DB scheme
@@ -17,7 +43,9 @@ class Schema:
         types: all attribute types of the DB
         defaults: default table and column names for original table names
         links: links between tables
+        join_paths: JoinPath of the shortest path between any two linked tables, by pair of tables
         type_dict: dictionary of types
+        re_placeholder: pattern of literal placeholders like TEXT@1
     """
 
     def __init__(self, filename):
@@ -29,7 +57,39 @@ class Schema:
         self.defaults = self.schema['defaults']
         if 'links' in self.schema:
             self.links = self.schema['links']
+        self.join_paths = self.index_join_paths() if 'links' in self.schema else {}
         self.type_dict = OrderedDict([(typ, [item for sublist in
                                              [[(col, ent) for col in self.tables[ent] if
                                                self.tables[ent][col]['type'] == typ] for ent
                                               in self.tables] for item in sublist]) for typ in self.types])
+        # one alternation over all types, longer types first like replacing them one after another
+        types = '|'.join(re.escape(typ) for typ in sorted(self.types, key=len, reverse=True))
+        self.re_placeholder = re.compile(f'(?:{types})@\\d+')
+
+    def index_join_paths(self):
+        """
+        find the shortest paths between all pairs of linked tables through a breadth first search from every table
+
+        :return dict: JoinPath by pair of first and last table
+        """
+
+        join_paths = {}
+        for start in self.links:
+            previous = {start: None}
+            queue = deque([start])
+            while queue:
+                table = queue.popleft()
+                for next_table in self.links[table]:
+                    if next_table not in previous:
+                        previous[next_table] = table
+                        queue.append(next_table)
+
+            for goal in previous:
+                if goal == start:
+                    continue
+                path = [goal]
+                while path[-1] != start:
+                    path.append(previous[path[-1]])
+                join_paths[(start, goal)] = JoinPath(path[::-1], self.links)
+
+        return join_paths
@@ -0,0 +1,121 @@
+# coding=utf-8
+""" checkpoints for resuming interrupted generation runs
+"""
+import logging
+import os
+import pickle
+import random
+import shutil
+
+
+class Checkpoint:
+    """
+    periodic checkpoint of a generation run at template line granularity
+
+    The samples of completed template lines are appended to the checkpoint directory in parts,
+    so every checkpoint only writes the lines completed since the previous one.
+    A state file records the completed lines, the part files and the random state.
+
+    Attributes:
+        str directory: checkpoint directory
+        str fingerprint: identifies the input of the run; a checkpoint is only restored for the same input
+        int interval: number of template lines between checkpoints
+        int completed: number of template lines completed (including pending ones)
+        list parts: part files written so far
+        list pending: samples of completed template lines not yet written
+    """
+
+    def __init__(self, directory, fingerprint, interval):
+        """
+        create checkpoint
+
+        :param str directory: checkpoint directory
+        :param str fingerprint: fingerprint of the input of the run
+        :param int interval: number of template lines between checkpoints
+        """
+        self.directory = directory
+        self.fingerprint = fingerprint
+        self.interval = interval
+
+        self.completed = 0
+        self.parts = []
+        self.pending = []
+
+    def state_file(self):
+        """
+        :return str: path of the state file
+        """
+        return os.path.join(self.directory, 'state.pickle')
+
+    def restore(self):
+        """
+        restore the last checkpoint, including the random state
+
+        :return list: samples of the completed template lines, in order
+        """
+        if not os.path.exists(self.state_file()):
+            logging.warning(f'no checkpoint found in {self.directory}, starting from the first template')
+            return []
+
+        with open(self.state_file(), 'rb') as open_file:
+            state = pickle.load(open_file)
+
+        assert state['fingerprint'] == self.fingerprint, \
+            f'checkpoint in {self.directory} was created for different input or parameters'
+
+        shards = []
+        for part in state['parts']:
+            with open(os.path.join(self.directory, part), 'rb') as open_file:
+                shards.extend(pickle.load(open_file))
+
+        self.completed = state['completed']
+        self.parts = state['parts']
+        random.setstate(state['random_state'])
+
+        logging.info(f'resuming after {self.completed} completed template lines')
+
+        return shards
+
+    def add(self, shard):
+        """
+        register the samples of a completed template line, write a checkpoint if the interval is reached
+
+        :param tuple shard: samples generated from the template line
+        """
+        self.pending.append(shard)
+        self.completed += 1
+
+        if len(self.pending) >= self.interval:
+            self.save()
+
+    def save(self):
+        """
+        write pending samples and the current state; files are replaced atomically
+        """
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+        part = f'part-{self.completed:06d}.pickle'
+        with open(os.path.join(self.directory, part + '.tmp'), 'wb') as open_file:
+            pickle.dump(self.pending, open_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(os.path.join(self.directory, part + '.tmp'), os.path.join(self.directory, part))
+
+        self.parts.append(part)
+        self.pending = []
+
+        state = {'fingerprint': self.fingerprint,
+                 'completed': self.completed,
+                 'parts': self.parts,
+                 'random_state': random.getstate()}
+        with open(self.state_file() + '.tmp', 'wb') as open_file:
+            pickle.dump(state, open_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(self.state_file() + '.tmp', self.state_file())
+
+        logging.debug(f'checkpoint after {self.completed} template lines')
+
+    def remove(self):
+        """
+        delete the checkpoint directory after a completed run
+        """
+        if os.path.exists(self.directory):
+            shutil.rmtree(self.directory)
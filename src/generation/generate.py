@@ -3,29 +3,35 @@
 Synthetic Data Generation for NL to SQL translation in Databases.
 
 Call this file to start data generation, db parameter is obligatory.
+Several databases (or 'all') are generated in one process, or in a pool of forked worker processes,
+loading templates, dictionary, PPDB and json schema only once.
 See help strings below for further parameters.
 """
 
 import argparse
+import gc
 import logging
+import multiprocessing
+import os
 import random
+import sys
+from copy import copy
 from time import strftime
 
 import numpy as np
 
-from generation.generator import Generator
+from generation.generator import Generator, load_resources
 
 
-def generation_parameters():
+def argument_parser(description='Initiate Data Generation Pipeline'):
     """
-    create generation ArgumentParser and process given parameters
+    create generation ArgumentParser with all arguments but the database, which is added by the caller
 
-    :return Namespace: arguments parsed by ArgumentParser
+    :param str description: description of the calling script
+    :return ArgumentParser: parser for generation parameters
     """
 
-    parser = argparse.ArgumentParser(description='Initiate Data Generation Pipeline')
-
-    parser.add_argument('-db', help='database name (required)', required=True)
+    parser = argparse.ArgumentParser(description=description)
 
     # file/directory arguments
     parser.add_argument('-db_dir', help='database directory, defaults to data/spider/database/<db>')
@@ -35,6 +41,14 @@ def generation_parameters():
     parser.add_argument('-templates', default='data/templates.txt', help='file containing NL/SQL templates')
     parser.add_argument('-ppdb_file', default='data/ppdb/ppdb.json', help='PPDB file for paraphrasing')
     parser.add_argument('-out_dir', help='output directory; if not specified, defaults to data/spider/synthetic/<db>/')
+    parser.add_argument('-cache_dir', help='cache generated samples per template line; only changed lines are generated')
+    parser.add_argument('-checkpoint_every', type=int, default=0,
+                        help='write a checkpoint to <out_dir>/checkpoint every n template lines; 0 (default) to disable')
+    parser.add_argument('-resume', action='store_true',
+                        help='resume an interrupted run from its last checkpoint; requires -checkpoint_every')
+    parser.add_argument('-processes', type=int, default=1, help='number of worker processes for several databases')
+    parser.add_argument('-canonical_cache_size', type=int, default=10000,
+                        help='number of SQL skeletons whose canonical form and label are cached; 0 to disable')
 
     # Logging arguments
     parser.add_argument('-verbose', action='store_true', help='log low importance info, progress and debugging info')
@@ -49,6 +63,7 @@ def generation_parameters():
     parser.add_argument('-no_canonical', action='store_true', help='do not canonicalize sql queries')
     parser.add_argument('-validate', action='store_true', help='validate generated queries with sqlite database')
     parser.add_argument('-fill_literals', action='store_true', help='fill literal placeholders with values from DB')
+    parser.add_argument('-seed', type=int, default=42, help='seed for all sources of randomness')
 
     # slot filling parameters
     parser.add_argument('-group_by_p', type=float, default=0.292, help='P(GROUP BY template from oen with aggregation)')
@@ -57,6 +72,8 @@ def generation_parameters():
     parser.add_argument('-func_boost', type=int, default=3, help='function layer boost (higher=less function queries)')
     parser.add_argument('-argmax_boost', type=int, default=3, help='argmax query slot-filling layer boost')
     parser.add_argument('-join_boost', type=int, default=2, help='join query slot-filling layer boost')
+    parser.add_argument('-max_join_variants', type=int, default=0,
+                        help='JOIN queries per template, sampled by how many linked tables can fill them; 0 for all')
     parser.add_argument('-in_boost', type=int, default=3, help='in query slot-filling layer boost')
     parser.add_argument('-threshold', type=int, default=6, help='recursive level to start filtering')
     parser.add_argument('-query_bound', type=int, default=5000, help='loose bound on queries generated per template')
@@ -69,9 +86,42 @@ def generation_parameters():
     parser.add_argument('-rand_drop_scale', type=int, default=0, help='random word drop scale; no. tokens per NL query')
     parser.add_argument('-adjective_scale', type=int, default=3, help='number of adjectives used per template slot')
 
-    params = parser.parse_args()
+    return parser
+
+
+def process_parameters(params):
+    """
+    set default values and dependent parameters not handled by ArgumentParser, apart from database dependent ones
+
+    :param Namespace params: arguments parsed by ArgumentParser
+    :return Namespace: processed arguments
+    """
+
+    assert not params.resume or params.checkpoint_every > 0, '-resume requires checkpoints, set -checkpoint_every'
 
-    # default values and dependent parameters not handled by ArgumentParser
+    # set p to zero if group_by is disabled
+    if params.no_group_by:
+        params.group_by_p = 0
+
+    # toy mode
+    if params.toy:
+        params.query_bound = 5
+        params.threshold = 3
+        params.verbose = True
+    return params
+
+
+def db_parameters(params, db):
+    """
+    create parameters for a database with database dependent default values
+
+    :param Namespace params: processed arguments
+    :param str db: database name
+    :return Namespace: copy of the arguments for the database
+    """
+
+    params = copy(params)
+    params.db = db
 
     # set default value for data base directory dependent on db
     if not params.db_dir:
@@ -85,29 +135,93 @@ def generation_parameters():
     # add trailing slash on output directory if necessary
     if params.out_dir[-1] != '/':
         params.out_dir += '/'
-    # set p to zero if group_by is disabled
-    if params.no_group_by:
-        params.group_by_p = 0
+    return params
+
+
+def generation_parameters():
+    """
+    create generation ArgumentParser and process given parameters
+
+    :return Namespace: arguments parsed by ArgumentParser, with a list of database names
+    """
+
+    parser = argument_parser()
+    parser.add_argument('-db', nargs='+', required=True,
+                        help="database names or 'all' for every DB in the json schema file (required)")
+
+    params = process_parameters(parser.parse_args())
+
+    if len(params.db) > 1 or params.db == ['all']:
+        assert not (params.db_dir or params.schema), 'db_dir and schema can only be specified for a single database'
 
-    # toy mode
-    if params.toy:
-        params.query_bound = 5
-        params.threshold = 3
-        params.verbose = True
     return params
 
 
-if __name__ == '__main__':
-    """set up argument parser, process arguments and call generate method
+def database_parameters(params, tables):
     """
+    create the parameters for every requested database
 
-    # seed sources of randomness to be able to reproduce results
-    random.seed(42)
-    np.random.seed(42)
+    With several databases, a given output directory receives one subdirectory per database.
+
+    :param Namespace params: processed arguments
+    :param list tables: content of the json schema file
+    :return list: parameters for each database
+    """
+
+    dbs = params.db
+    if dbs == ['all']:
+        dbs = []
+        for db in (db_info['db_id'] for db_info in tables):
+            if os.path.exists(db_parameters(params, db).schema):
+                dbs.append(db)
+            else:
+                logging.warning(f'skipping {db}, no schema file')
+
+    db_params = []
+    for db in dbs:
+        db_params.append(db_parameters(params, db))
+        if params.out_dir and len(dbs) > 1:
+            db_params[-1].out_dir = os.path.join(params.out_dir, db, '')
+
+    return db_params
+
+
+# input shared by all databases; loaded before forking worker processes, which inherit it copy-on-write
+SHARED_RESOURCES = {}
+
+
+def generate_db(params):
+    """
+    generate and output samples for one database
+
+    Errors are logged with their traceback instead of raised, so that the other databases of a sweep are generated.
+
+    :param Namespace params: parameters for the database
+    :return tuple: database name and whether generation succeeded
+    """
+
+    try:
+        generator = Generator(params, **SHARED_RESOURCES)
+        generator.generate_from_input()
+        generator.output_samples()
+    except Exception:
+        logging.exception(f'generation failed for {params.db}')
+        return params.db, False
+
+    return params.db, True
+
+
+if __name__ == '__main__':
+    """set up argument parser, process arguments and call generate method for every database
+    """
 
     # retrieve and process parameters
     parameters = generation_parameters()
 
+    # seed sources of randomness to be able to reproduce results
+    random.seed(parameters.seed)
+    np.random.seed(parameters.seed)
+
     # setup logging
     if parameters.verbose:
         logging.basicConfig(filename=parameters.log, level=logging.DEBUG)
@@ -117,7 +231,22 @@ if __name__ == '__main__':
     if parameters.toy:
         logging.warning('toy mode active')
 
+    # load templates, dictionary, PPDB and json schema once for all databases
+    SHARED_RESOURCES.update(load_resources(parameters))
+    databases = database_parameters(parameters, SHARED_RESOURCES['tables'])
+
     # start training data generator
-    generator = Generator(parameters)
-    generator.generate_from_input()
-    generator.output_samples()
+    if parameters.processes > 1 and len(databases) > 1:
+        # exclude shared objects from garbage collection, which would otherwise copy their pages in every worker
+        gc.freeze()
+        with multiprocessing.get_context('fork').Pool(parameters.processes) as pool:
+            results = []
+            for db, success in pool.imap_unordered(generate_db, databases):
+                logging.info(f'finished {db}')
+                results.append((db, success))
+    else:
+        results = [generate_db(database) for database in databases]
+
+    failed = sorted(db for db, success in results if not success)
+    if failed:
+        sys.exit(f'generation failed for {len(failed)} of {len(results)} databases: {", ".join(failed)}')
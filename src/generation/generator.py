@@ -2,18 +2,43 @@
 """ synthetic data generator class
 """
 
+import hashlib
 import json
 import logging
 import os
 import random
 from copy import deepcopy
+from itertools import chain
 
 from db.database import Database
 from db.schema import Schema
-from generation.generator_utils import read_lines_from_file, parse_dict
+from generation.checkpoint import Checkpoint
+from generation.generator_utils import read_lines_from_file, parse_dict, template_seed, SlotDictionary
+from generation.template_cache import TemplateCache, context_fingerprint
 from paraphrasing.ppdb import PPDB
-from query.query import Query
+from query.query import Query, QueryContext
 from query.query_utils import tokenize_nl, tokenize_sql
+from query.sample_store import expand, dump_samples
+
+
+def load_resources(parameters):
+    """
+    load the input shared by generators for different DBs
+
+    :param Namespace parameters: Namespace containing script arguments
+    :return dict: keyword arguments for Generator with templates, slot filling dictionary, paraphraser and json schema
+    """
+
+    with open(parameters.json_schema) as open_file:
+        tables = json.load(open_file)
+
+    return {'templates': read_lines_from_file(parameters.templates),
+            'slot_filling_dictionary': parse_dict(parameters.dict),
+            'paraphraser': PPDB(parameters.ppdb_file,
+                                parameters.pp_scale,
+                                parameters.rand_drop_scale,
+                                parameters.rand_drop_p),
+            'tables': tables}
 
 
 class Generator(object):
@@ -22,22 +47,32 @@ class Generator(object):
 
     Attributes:
         Namespace parameters: a namespace containing all generation parameters; for documentation see generate.py
-        dict slot_filling_dictionary: a dictionary containing word groups for slot-filling in natural language queries
+        SlotDictionary slot_filling_dictionary: word groups for slot-filling in natural language queries
         list templates: list of templates for NL/SQL query pairs
         PPDB paraphraser: Paraphraser for creating alternate formulations of NL queries
         Schema schema: database schema
+        QueryContext query_context: schema and parameters shared by all generated queries
         Database database: representing the database to work on
-        list json_samples: list of samples for json output
+        TemplateCache cache: cache for the samples generated from each template line, None if disabled
+        Checkpoint checkpoint: periodic checkpoint of generated samples, None if disabled
+        list json_samples: list of samples for json output, pairs of SqlRecord and question
         list json_validation_samples: list of samples in validation split for json output
         list training_data_split: training split of the generated data
         list validation_data_split: validation split (if requested in parameters) of the generated data
     """
 
-    def __init__(self, parameters):
+    def __init__(self, parameters, templates=None, slot_filling_dictionary=None, paraphraser=None, tables=None):
         """
         initiate Generator and load necessary input from files
 
+        Templates, dictionary, paraphraser and json schema may be passed in to share them between generators for
+        several DBs, see load_resources.
+
         :param Namespace parameters: Namespace containing script arguments
+        :param list templates: template lines, read from the templates file if not provided
+        :param dict slot_filling_dictionary: slot filling dictionary, read from the dictionary file if not provided
+        :param PPDB paraphraser: paraphraser, loaded from the PPDB file if not provided
+        :param list tables: content of the json schema file, read from the file if not provided
         """
 
         self.parameters = parameters
@@ -49,19 +84,42 @@ class Generator(object):
         self.json_validation_samples = []
 
         # retrieve templates and slot-filling dictionary
-        self.templates = read_lines_from_file(self.parameters.templates)
-        self.slot_filling_dictionary = parse_dict(self.parameters.dict)
+        self.templates = templates if templates is not None else read_lines_from_file(self.parameters.templates)
+        self.slot_filling_dictionary = slot_filling_dictionary if slot_filling_dictionary is not None else \
+            parse_dict(self.parameters.dict)
+        if not isinstance(self.slot_filling_dictionary, SlotDictionary):
+            self.slot_filling_dictionary = SlotDictionary(self.slot_filling_dictionary)
 
         # Instantiate paraphraser, schema, and database
         self.schema = Schema(self.parameters.schema)
+        self.query_context = QueryContext(self.schema, self.parameters)
         self.database = Database(self.parameters.db,
                                  self.parameters.db_dir,
                                  self.schema,
-                                 self.parameters.json_schema)
-        self.paraphraser = PPDB(self.parameters.ppdb_file,
-                                self.parameters.pp_scale,
-                                self.parameters.rand_drop_scale,
-                                self.parameters.rand_drop_p)
+                                 self.parameters.json_schema,
+                                 tables,
+                                 self.parameters.canonical_cache_size)
+        self.paraphraser = paraphraser if paraphraser is not None else PPDB(self.parameters.ppdb_file,
+                                                                            self.parameters.pp_scale,
+                                                                            self.parameters.rand_drop_scale,
+                                                                            self.parameters.rand_drop_p)
+
+        context = None
+        if self.parameters.cache_dir or self.parameters.checkpoint_every:
+            context = context_fingerprint(self.parameters, self.database.db_info)
+
+        self.cache = None
+        if self.parameters.cache_dir:
+            self.cache = TemplateCache(self.parameters.cache_dir, context)
+
+        self.checkpoint = None
+        if self.parameters.checkpoint_every:
+            run_fingerprint = hashlib.sha256(context.encode('utf8'))
+            run_fingerprint.update(json.dumps([self.templates, self.slot_filling_dictionary]).encode('utf8'))
+            self.checkpoint = Checkpoint(self.parameters.out_dir + 'checkpoint',
+                                         run_fingerprint.hexdigest(),
+                                         self.parameters.checkpoint_every)
+        assert self.checkpoint or not self.parameters.resume, '-resume requires checkpoints, set -checkpoint_every'
 
     def generate(self, query, samples):
         """
@@ -69,6 +127,7 @@ class Generator(object):
 
         :param Query query: current query
         :param list samples: previously generated samples for this query
+        :return generator: samples as pairs of SqlRecord and question, yielded as soon as a query is output
         """
 
         # limit per-template sample production
@@ -82,7 +141,7 @@ class Generator(object):
                 queries = query.fill_slots(token, self.slot_filling_dictionary)
                 for new_query in queries:
                     try:
-                        self.generate(new_query, samples)
+                        yield from self.generate(new_query, samples)
                     except RecursionError:
                         logging.error(f'recursion depth exceeded in {new_query}')
 
@@ -93,7 +152,9 @@ class Generator(object):
         # none of the current tokens is a template tag
         if not found_template_tag:
 
-            query.output(self.paraphraser, self.database, samples, self.json_samples)
+            json_samples = []
+            query.output(self.paraphraser, self.database, samples, json_samples)
+            yield from json_samples
 
             # TODO move?
             # generate additional group by queries
@@ -106,7 +167,96 @@ class Generator(object):
                 new_query.sql_tokens = tokenize_sql(new_sql)
                 new_query.groupable = False
 
-                self.generate(new_query, samples)
+                yield from self.generate(new_query, samples)
+
+    def iter_template_samples(self, template_line, seed=None):
+        """
+        generate samples from a single line of the templates file
+
+        Each line is generated from its own random stream and with a reset paraphraser,
+        so the samples of a line only depend on the line itself, the dictionary, the DB, the parameters and the seed.
+
+        :param str template_line: NL templates and SQL template separated by tabs
+        :param int seed: seed of the run, defaults to the seed parameter
+        :return generator: samples as pairs of SqlRecord and question
+        """
+
+        random.seed(template_seed(self.parameters.seed if seed is None else seed, template_line))
+        self.paraphraser.reset()
+        self.database.sql_memo.start_line()
+
+        query_templates = template_line.split('\t')
+        sql_template = query_templates.pop()
+
+        for nl_template in query_templates:
+
+            original_query = Query(nl_template, sql_template, self.query_context)
+            logging.debug(f'generating NL from: {original_query.get_nl()}')
+
+            # generate query for  every combination of linked tables in multi-table queries
+            queries = original_query.create_join_placeholder()
+            # create argmin/argmax queries
+            queries = chain(queries, original_query.create_argmin_max())
+
+            for query in queries:
+                samples = []
+                yield from self.generate(query, samples)
+
+                logging.info(f'count: {len(samples)}')
+
+        logging.info(self.database.sql_memo.statistics())
+
+    def generate_from_template(self, template_line):
+        """
+        generate training data from a single line of the templates file
+
+        :param str template_line: NL templates and SQL template separated by tabs
+        :return tuple: list of NL/SQL pairs and list of samples as pairs of SqlRecord and question
+        """
+
+        json_samples = list(self.iter_template_samples(template_line))
+        training_samples = [(question, record.query) for record, question in json_samples]
+
+        return training_samples, json_samples
+
+    def iter_samples(self, worker_id=0, num_workers=1, seed=None):
+        """
+        stream generated samples without collecting them
+
+        Samples are yielded as soon as their query is output, so at most the paraphrases of one query are buffered.
+        Template lines are sharded round-robin over workers: processes with the same parameters and seed but
+        different worker ids produce disjoint streams which together contain all samples of a full run.
+        Random state and paraphraser state are kept per stream, so several streams of one generator may be
+        consumed alternately.
+
+        :param int worker_id: index of this worker, 0 <= worker_id < num_workers
+        :param int num_workers: total number of workers
+        :param int seed: seed of the run, defaults to the seed parameter
+        :return generator: json formatted samples with question, query, sql label and variables
+        """
+
+        assert 0 <= worker_id < num_workers, f'worker id {worker_id} out of range for {num_workers} workers'
+
+        stream = (sample
+                  for index, line in enumerate(self.templates) if index % num_workers == worker_id
+                  for sample in self.iter_template_samples(line, seed))
+
+        # state of this stream, swapped in while the stream is advanced
+        stream_state = (random.getstate(), {}, {})
+        while True:
+            outer_state = (random.getstate(), self.paraphraser.position, self.paraphraser.order)
+            random.setstate(stream_state[0])
+            self.paraphraser.position, self.paraphraser.order = stream_state[1], stream_state[2]
+            try:
+                sample = next(stream, None)
+            finally:
+                stream_state = (random.getstate(), self.paraphraser.position, self.paraphraser.order)
+                random.setstate(outer_state[0])
+                self.paraphraser.position, self.paraphraser.order = outer_state[1], outer_state[2]
+
+            if sample is None:
+                return
+            yield expand(sample)
 
     def generate_from_input(self):
         """ generate training data from templates and a slot filling dictionary
@@ -114,36 +264,42 @@ class Generator(object):
 
         logging.info(f'generating from dictionary {self.parameters.dict} and template file {self.parameters.templates}')
 
-        sample_count = 0
         self.training_data_split = []
+        self.json_samples = []
 
-        for line in self.templates:
-
-            previous_count = sample_count
+        # continue after the template lines completed in an interrupted run
+        completed = 0
+        if self.checkpoint and self.parameters.resume:
+            for samples, json_samples in self.checkpoint.restore():
+                self.training_data_split.extend(samples)
+                self.json_samples.extend(json_samples)
+            completed = self.checkpoint.completed
 
-            query_templates = line.split('\t')
-            sql_template = query_templates.pop()
+        for line in self.templates[completed:]:
 
-            for nl_template in query_templates:
+            shard = None
+            if self.cache:
+                key = self.cache.key(line, self.slot_filling_dictionary,
+                                     template_seed(self.parameters.seed, line))
+                shard = self.cache.load(key)
 
-                original_query = Query(nl_template, sql_template, self.schema, self.parameters)
-                logging.debug(f'generating NL from: {original_query.get_nl()}')
+            if shard is None:
+                shard = self.generate_from_template(line)
+                if self.cache:
+                    self.cache.store(key, shard)
 
-                # generate query for  every combination of linked tables in multi-table queries
-                queries = original_query.create_join_placeholder()
-                # create argmin/argmax queries
-                queries += original_query.create_argmin_max()
+            if self.checkpoint:
+                self.checkpoint.add(shard)
 
-                for query in queries:
-                    samples = []
-                    self.generate(query, samples)
-                    self.training_data_split.extend(samples)
+            samples, json_samples = shard
+            self.training_data_split.extend(samples)
+            self.json_samples.extend(json_samples)
 
-                    new_sample_count = len(self.training_data_split)
-                    logging.info(f'count: {new_sample_count - sample_count} out of total: {new_sample_count}')
-                    sample_count = new_sample_count
+            logging.info(f'total count for template: {len(samples)}')
 
-            logging.info(f'total count for template: {sample_count - previous_count}')
+        if self.cache:
+            logging.info(f'template cache: {self.cache.hits} lines reused, {self.cache.misses} lines generated')
+        logging.info(self.database.canonical_cache.statistics())
 
         former_size = len(self.training_data_split)
         logging.info(f'total count generated from all templates: {former_size}')
@@ -178,6 +334,9 @@ class Generator(object):
 
         logging.info(f'Begin writing to {self.parameters.out_dir}*')
 
+        # the split does not depend on the random streams of the template lines (which may have been cached)
+        random.seed(self.parameters.seed)
+
         # if validation data set was requested: split off specified percentage randomly
         if self.parameters.validation_split:
 
@@ -209,10 +368,13 @@ class Generator(object):
             self.json_samples = self.json_samples[split_point:]
 
             with open(self.parameters.out_dir + 'dev.json', 'w') as v_json:
-                json.dump(self.json_validation_samples, v_json, sort_keys=True, indent=4, separators=(',', ': '))
+                dump_samples(self.json_validation_samples, v_json)
 
         # write (remaining) samples to training data files
         with open(self.parameters.out_dir + 'train.json', 'w') as t_json:
-            json.dump(self.json_samples, t_json, sort_keys=True, indent=4, separators=(',', ': '))
+            dump_samples(self.json_samples, t_json)
+
+        if self.checkpoint:
+            self.checkpoint.remove()
 
         logging.info('Finished output!')
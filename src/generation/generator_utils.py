@@ -1,6 +1,11 @@
 # coding=utf-8
 """ Utility methods for synthetic training data generation
 """
+import hashlib
+import json
+import re
+
+RE_SLOT = re.compile(r'{[^{}]*\}')
 
 
 def read_lines_from_file(filename):
@@ -19,7 +24,7 @@ def parse_dict(dictionary_file):
     parse one mapping per line through '=>' from dictionary file
 
     :param str dictionary_file: path to dictionary file
-    :return dict: dictionary mapping keys to values according to dict_file
+    :return SlotDictionary: dictionary mapping keys to values according to dict_file
     """
     lines = read_lines_from_file(dictionary_file)
     dictionary = {}
@@ -30,4 +35,93 @@ def parse_dict(dictionary_file):
         (key, values) = line.split('=>')
         dictionary[key.strip()] = [v.strip() for v in values.split('|') if v and not v.isspace()]
 
-    return dictionary
+    return SlotDictionary(dictionary)
+
+
+def template_seed(seed, template_line):
+    """
+    derive the seed of the random stream used for a single template line
+
+    every template line is generated from its own random stream, so its output does not depend on other lines
+
+    :param int seed: seed of the generation run
+    :param str template_line: line from the templates file
+    :return int: seed for the given template line
+    """
+    digest = hashlib.sha256(f'{seed}\t{template_line}'.encode('utf8')).digest()
+    return int.from_bytes(digest[:8], 'big')
+
+
+def reachable_slots(text, dictionary):
+    """
+    collect the slots in a text and all slots reachable from them through the slot filling dictionary
+
+    :param str text: template text containing slots in {}
+    :param dict dictionary: slot filling dictionary
+    :return set: reachable slots
+    """
+    slots = set()
+    pending = RE_SLOT.findall(text)
+    while pending:
+        slot = pending.pop()
+        if slot in slots:
+            continue
+        slots.add(slot)
+        for value in dictionary.get(slot, []):
+            pending.extend(RE_SLOT.findall(value))
+
+    return slots
+
+
+class SlotDictionary(dict):
+    """
+    slot filling dictionary with everything that does not depend on the DB computed once, so the generators of all
+    DBs share it instead of repeating it for every DB
+
+    The values themselves are still drawn while generating, from the random stream of the template line, as the
+    draws are interleaved with the filling of tables and columns and pruned by the recursion depth.
+
+    The dictionary is read-only with values stored as tuples, so the precomputed attributes cannot go stale.
+
+    Attributes:
+        dict fills: NL and SQL form of every value, by slot
+        dict closures: slots reachable from a slot, including the slot itself
+        dict line_entries: dictionary entries reachable from a template line as json, by line
+    """
+
+    def __init__(self, dictionary):
+        """
+        :param dict dictionary: dictionary mapping slots to values
+        """
+        super().__init__((slot, tuple(values)) for slot, values in dictionary.items())
+
+        self.fills = {slot: [(value, value.upper()) for value in values] for slot, values in self.items()}
+        self.closures = {slot: frozenset(reachable_slots(slot, self)) for slot in self}
+        self.line_entries = {}
+
+    def read_only(self, *args, **kwargs):
+        """
+        replaces all methods that would modify the dictionary
+        """
+        raise TypeError('SlotDictionary is read-only, create a new one from a modified dict instead')
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = read_only
+
+    def __reduce__(self):
+        # pickle and copy rebuild the dictionary instead of setting its items one by one
+        return SlotDictionary, (dict(self),)
+
+    def entries(self, text):
+        """
+        entries of all slots reachable from a text, e.g. to detect changes of the dictionary that affect a template line
+
+        :param str text: template text containing slots in {}
+        :return str: json of the reachable entries, sorted by slot
+        """
+        if text not in self.line_entries:
+            slots = set()
+            for slot in RE_SLOT.findall(text):
+                slots |= self.closures.get(slot, {slot})
+            self.line_entries[text] = json.dumps([(slot, self[slot]) for slot in sorted(slots) if slot in self])
+
+        return self.line_entries[text]
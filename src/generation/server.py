@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+"""
+Local server streaming freshly generated samples to training jobs.
+
+Schema, database, PPDB and templates are loaded once for all requested DBs and kept in memory.
+Clients connect through TCP on localhost or a unix socket and exchange newline delimited json:
+
+    request:  {"count": 32, "seed": 7, "dbs": ["concert_singer"]}
+    response: {"samples": [...]}
+
+Every connection keeps its own sample streams per DB and seed, so a client with a given seed always receives the
+same sequence of samples. "dbs" optionally restricts a request to a subset of the served DBs.
+Generation parameters are the same as for generate.py, see help strings there.
+"""
+
+import asyncio
+import json
+import logging
+import random
+from time import perf_counter
+
+from generation.generate import argument_parser, process_parameters, db_parameters
+from generation.generator import Generator, load_resources
+from generation.generator_utils import template_seed
+
+
+class ClientStreams:
+    """
+    sample streams of one client connection
+
+    Each DB has an endless stream which restarts with a new seed derived from the client seed once all templates
+    have been generated. DBs are mixed according to a random stream seeded with the client seed.
+
+    Attributes:
+        dict generators: generators of the served DBs
+        int seed: client seed
+        dict streams: sample stream per DB
+        dict epochs: number of completed passes over the templates per DB
+        Random mix: random stream for choosing the DB of the next sample
+    """
+
+    def __init__(self, generators, seed):
+        """
+        :param dict generators: mapping DB names to warm generators
+        :param int seed: client seed
+        """
+        self.generators = generators
+        self.seed = seed
+        self.streams = {}
+        self.epochs = {}
+        self.mix = random.Random(seed)
+
+    def next_sample(self, db):
+        """
+        :param str db: DB name
+        :return dict: next json formatted sample for the DB, None if the DB does not produce any samples
+        """
+        for _ in range(2):
+            if db not in self.streams:
+                epoch = self.epochs.setdefault(db, 0)
+                self.streams[db] = self.generators[db].iter_samples(seed=template_seed(self.seed, f'epoch {epoch}'))
+
+            try:
+                sample = next(self.streams[db], None)
+            except Exception:
+                # a failed stream cannot be resumed, the next request of the client continues with the next pass
+                del self.streams[db]
+                self.epochs[db] += 1
+                raise
+            if sample is not None:
+                return sample
+
+            # pass over all templates finished, continue with the next one
+            del self.streams[db]
+            self.epochs[db] += 1
+
+        logging.error(f'no samples generated for {db}')
+        return None
+
+    async def batch(self, count, dbs):
+        """
+        generate a batch, handing control back to the event loop after every sample
+
+        :param int count: number of samples
+        :param list dbs: DBs to draw samples from
+        :return list: json formatted samples
+        """
+        samples = []
+        dbs = list(dbs)
+        while len(samples) < count and dbs:
+            db = self.mix.choice(dbs)
+            sample = self.next_sample(db)
+            if sample is None:
+                dbs.remove(db)
+            else:
+                samples.append(sample)
+            await asyncio.sleep(0)
+
+        return samples
+
+
+class SampleServer:
+    """
+    asyncio server handing out batches of generated samples
+
+    Generation runs in the event loop itself and yields to it after every sample, so the batches of concurrent clients
+    are generated interleaved sample by sample. The streams swap the global random state while they are advanced, so
+    they are not run in threads. A generation error is answered with an error response and only ends the pass of
+    the failed stream.
+
+    Attributes:
+        dict generators: mapping DB names to warm generators
+        int max_batch: maximum number of samples per request
+        int served: number of samples served so far
+    """
+
+    def __init__(self, generators, max_batch):
+        """
+        :param dict generators: mapping DB names to warm generators
+        :param int max_batch: maximum number of samples per request
+        """
+        self.generators = generators
+        self.max_batch = max_batch
+        self.served = 0
+
+    async def respond(self, request, clients):
+        """
+        :param dict request: decoded request
+        :param dict clients: streams of the connection per client seed
+        :return dict: response
+        """
+        count = min(int(request.get('count', 1)), self.max_batch)
+        seed = int(request.get('seed', 0))
+        dbs = request.get('dbs') or list(self.generators)
+
+        unknown = [db for db in dbs if db not in self.generators]
+        if unknown:
+            return {'error': f'DBs not served: {unknown}'}
+
+        streams = clients.setdefault(seed, ClientStreams(self.generators, seed))
+        try:
+            samples = await streams.batch(count, dbs)
+        except Exception as e:
+            logging.exception(f'generation failed for client seed {seed}')
+            return {'error': f'generation failed: {e!r}'}
+        self.served += len(samples)
+
+        return {'samples': samples}
+
+    async def handle_client(self, reader, writer):
+        """
+        serve requests of one connection until it is closed
+
+        :param StreamReader reader: connection input
+        :param StreamWriter writer: connection output
+        """
+        clients = {}
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+
+            start = perf_counter()
+            try:
+                response = await self.respond(json.loads(line), clients)
+            except (ValueError, TypeError, AttributeError) as e:
+                response = {'error': f'malformed request: {e}'}
+            logging.debug(f'served {len(response.get("samples", []))} samples in {perf_counter() - start:.3f}s')
+
+            writer.write(json.dumps(response).encode('utf8') + b'\n')
+            await writer.drain()
+
+        writer.close()
+
+    async def serve(self, host, port, socket_path=None):
+        """
+        accept connections until cancelled
+
+        :param str host: host name for TCP connections
+        :param int port: port for TCP connections
+        :param str socket_path: path of a unix socket, used instead of TCP if given
+        """
+        if socket_path:
+            server = await asyncio.start_unix_server(self.handle_client, path=socket_path, limit=1 << 24)
+        else:
+            server = await asyncio.start_server(self.handle_client, host, port, limit=1 << 24)
+
+        logging.info(f'serving samples for {", ".join(self.generators)}')
+        async with server:
+            await server.serve_forever()
+
+
+async def request_samples(reader, writer, count, seed=0, dbs=None):
+    """
+    request a batch of samples from a sample server
+
+    :param StreamReader reader: connection input
+    :param StreamWriter writer: connection output
+    :param int count: number of samples
+    :param int seed: client seed
+    :param list dbs: DBs to draw samples from, all served DBs if None
+    :return list: json formatted samples
+    """
+    request = {'count': count, 'seed': seed}
+    if dbs:
+        request['dbs'] = dbs
+
+    writer.write(json.dumps(request).encode('utf8') + b'\n')
+    await writer.drain()
+    response = json.loads(await reader.readline())
+
+    assert 'error' not in response, response.get('error')
+    return response['samples']
+
+
+def load_generators(params, dbs):
+    """
+    load templates, dictionary, PPDB and json schema once and create a generator for each DB
+
+    :param Namespace params: processed generation parameters
+    :param list dbs: DB names
+    :return dict: mapping DB names to generators
+    """
+    resources = load_resources(params)
+
+    generators = {}
+    for db in dbs:
+        generators[db] = Generator(db_parameters(params, db), **resources)
+        logging.info(f'loaded {db}')
+
+    return generators
+
+
+if __name__ == '__main__':
+    """set up argument parser, load generators for all DBs and serve until interrupted
+    """
+
+    parser = argument_parser('Serve generated samples')
+    parser.add_argument('-db', nargs='+', required=True, help='names of the databases to serve (required)')
+    parser.add_argument('-host', default='127.0.0.1', help='host name to listen on')
+    parser.add_argument('-port', type=int, default=8765, help='port to listen on')
+    parser.add_argument('-socket', help='listen on this unix socket instead of TCP')
+    parser.add_argument('-max_batch', type=int, default=1024, help='maximum number of samples per request')
+    parameters = process_parameters(parser.parse_args())
+
+    # streams do not write checkpoints
+    parameters.checkpoint_every = 0
+
+    if parameters.verbose:
+        logging.basicConfig(filename=parameters.log, level=logging.DEBUG)
+    else:
+        logging.basicConfig(filename=parameters.log, level=logging.WARNING)
+
+    sample_server = SampleServer(load_generators(parameters, parameters.db), parameters.max_batch)
+    try:
+        asyncio.run(sample_server.serve(parameters.host, parameters.port, parameters.socket))
+    except KeyboardInterrupt:
+        logging.info(f'served {sample_server.served} samples')
@@ -0,0 +1,155 @@
+# coding=utf-8
+""" content-addressed cache for the samples generated from single template lines
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import pickle
+
+from query.query_utils import compDict, funcDict, argCommandDict, compSuperDict
+
+# increase whenever a change to the generation code invalidates previously cached outputs
+CACHE_VERSION = 4
+
+# parameters that do not influence the samples generated from a template line
+NON_GENERATIVE_PARAMETERS = {'db_dir', 'schema', 'json_schema', 'dict', 'templates', 'ppdb_file', 'out_dir', 'verbose',
+                             'log', 'toy', 'validation_split', 'cache_dir', 'checkpoint_every', 'resume',
+                             'processes', 'canonical_cache_size'}
+
+# slots that are not part of the template text but inserted while filling other slots
+IMPLICIT_SLOTS = ' '.join(list(compDict.values()) + list(funcDict.values()) + list(argCommandDict.values()) +
+                          ['{groupByToken}', '{withToken}'])
+
+
+def hash_file(hash_object, filename):
+    """
+    update a hash object with the content of a file
+
+    :param hash_object: hashlib hash object
+    :param str filename: path to the file
+    """
+    with open(filename, 'rb') as open_file:
+        for block in iter(lambda: open_file.read(1 << 20), b''):
+            hash_object.update(block)
+
+
+def context_fingerprint(parameters, db_info):
+    """
+    fingerprint everything apart from the template line and the slot filling dictionary that affects generation
+
+    covers the generation parameters, the schema file, the sqlite DB, the DB entry in the json schema file and
+    the adjective dictionary. The PPDB file is only identified through its size and modification time.
+
+    :param Namespace parameters: generation parameters
+    :param dict db_info: entry of the DB in the json schema file
+    :return str: hex digest
+    """
+    fingerprint = hashlib.sha256(f'version {CACHE_VERSION}'.encode('utf8'))
+
+    generative_parameters = {key: value for key, value in vars(parameters).items()
+                             if key not in NON_GENERATIVE_PARAMETERS}
+    fingerprint.update(json.dumps(generative_parameters, sort_keys=True, default=str).encode('utf8'))
+
+    hash_file(fingerprint, parameters.schema)
+    for db_file in sorted(glob.glob(parameters.db_dir + '/*.sqlite')):
+        hash_file(fingerprint, db_file)
+
+    fingerprint.update(json.dumps(db_info, sort_keys=True).encode('utf8'))
+
+    fingerprint.update(pickle.dumps(compSuperDict))
+
+    if parameters.pp_scale > 0:
+        ppdb_stat = os.stat(parameters.ppdb_file)
+        fingerprint.update(f'{ppdb_stat.st_size} {ppdb_stat.st_mtime_ns}'.encode('utf8'))
+
+    return fingerprint.hexdigest()
+
+
+class TemplateCache:
+    """
+    content-addressed store of the samples generated from single template lines
+
+    A cached entry is keyed by the template line, the dictionary entries reachable from it, the random stream seed
+    of the line and a fingerprint of the generation context (parameters, schema, DB), so that only lines affected by
+    a change have to be generated again.
+
+    Attributes:
+        str directory: cache directory
+        str context: fingerprint of the generation context
+        int hits: number of template lines loaded from the cache
+        int misses: number of template lines not found in the cache
+    """
+
+    def __init__(self, directory, context):
+        """
+        create template cache
+
+        :param str directory: cache directory, created if necessary
+        :param str context: fingerprint of the generation context, see context_fingerprint
+        """
+        self.directory = directory
+        self.context = context
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+    def key(self, template_line, dictionary, seed):
+        """
+        compute the cache key for a template line
+
+        :param str template_line: line from the templates file
+        :param SlotDictionary dictionary: slot filling dictionary
+        :param int seed: random stream seed of the template line
+        :return str: hex digest
+        """
+        key = hashlib.sha256(self.context.encode('utf8'))
+        key.update(template_line.encode('utf8'))
+        key.update(dictionary.entries(template_line + ' ' + IMPLICIT_SLOTS).encode('utf8'))
+        key.update(str(seed).encode('utf8'))
+
+        return key.hexdigest()
+
+    def path(self, key):
+        """
+        :param str key: cache key
+        :return str: path of the cache entry
+        """
+        return os.path.join(self.directory, key[:2], key + '.pickle')
+
+    def load(self, key):
+        """
+        load the samples for a key
+
+        :param str key: cache key
+        :return tuple: cached samples, None if not cached
+        """
+        try:
+            with open(self.path(key), 'rb') as open_file:
+                shard = pickle.load(open_file)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        return shard
+
+    def store(self, key, shard):
+        """
+        store the samples for a key; writes to a temporary file first so that entries are never partially written
+
+        :param str key: cache key
+        :param tuple shard: samples generated from the template line
+        """
+        path = self.path(key)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+
+        with open(path + '.tmp', 'wb') as open_file:
+            pickle.dump(shard, open_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+
+        logging.debug(f'cached template output under {key}')
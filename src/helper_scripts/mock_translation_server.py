@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+""" local stand-in for the Google translation API, to test pivot paraphrasing offline
+
+Answers POST requests with form encoded q (repeated for several queries), target and key like
+https://translation.googleapis.com/language/translate/v2. A translation prefixes the text with the target language,
+so 'which singer' translated through 'de|en' becomes 'en:de:which singer' and the order of results can be checked.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+def mock_translation(text, target):
+    """
+    :param str text: text to translate
+    :param str target: target language
+    :return str: mock translation
+    """
+    return f'{target}:{text}'
+
+
+class TranslationHandler(BaseHTTPRequestHandler):
+    """
+    handler answering translation requests; configured through attributes of the server
+
+    Attributes:
+        float server.latency: delay of every response in seconds
+        float server.fail_rate: probability of answering with 503
+        int server.max_queries: maximum number of queries per request
+        int server.requests: number of requests answered
+        int server.translations: number of queries translated
+    """
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf8'),
+                        keep_blank_values=True)
+        queries = form.get('q', [])
+        target = form.get('target', [''])[0]
+
+        time.sleep(self.server.latency)
+
+        with self.server.lock:
+            self.server.requests += 1
+
+        if random.random() < self.server.fail_rate:
+            self.respond(503, {'error': {'code': 503, 'message': 'mock failure'}})
+        elif not queries or not target or len(queries) > self.server.max_queries:
+            self.respond(400, {'error': {'code': 400, 'message': f'{len(queries)} queries to {target or "?"}'}})
+        else:
+            with self.server.lock:
+                self.server.translations += len(queries)
+            self.respond(200, {'data': {'translations': [{'translatedText': mock_translation(query, target),
+                                                          'detectedSourceLanguage': 'en'} for query in queries]}})
+
+    def respond(self, status, content):
+        """
+        :param int status: HTTP status code
+        :param dict content: json response
+        """
+        body = json.dumps(content).encode('utf8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def make_server(port, latency=0.0, fail_rate=0.0, max_queries=128):
+    """
+    create a mock translation server listening on localhost
+
+    :param int port: port, 0 for any free port
+    :param float latency: delay of every response in seconds
+    :param float fail_rate: probability of answering with 503
+    :param int max_queries: maximum number of queries per request, as for the Google API
+    :return ThreadingHTTPServer: server, call serve_forever to start
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', port), TranslationHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.fail_rate = fail_rate
+    server.max_queries = max_queries
+    server.lock = threading.Lock()
+    server.requests = 0
+    server.translations = 0
+
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='mock_translation_server.py')
+
+    parser.add_argument('-port', type=int, default=8766, help='port to listen on')
+    parser.add_argument('-latency', type=float, default=0.05, help='delay of every response in seconds')
+    parser.add_argument('-fail_rate', type=float, default=0.0, help='probability of answering a request with 503')
+    parser.add_argument('-max_queries', type=int, default=128, help='maximum number of queries per request')
+
+    args = parser.parse_args()
+
+    mock_server = make_server(args.port, args.latency, args.fail_rate, args.max_queries)
+    print(f'serving mock translations on http://127.0.0.1:{mock_server.server_address[1]}/')
+    try:
+        mock_server.serve_forever()
+    except KeyboardInterrupt:
+        print(f'{mock_server.translations} translations in {mock_server.requests} requests')
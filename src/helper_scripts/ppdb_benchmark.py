@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+""" benchmark load time, memory and lookup throughput of PPDB files in json and compact format
+
+Every file is measured in a fresh process. Lookups mix tokens with and without paraphrases the way PPDB does:
+a membership test for every token and a paraphrase list for the tokens found.
+"""
+import argparse
+import json
+import random
+import resource
+import subprocess
+import sys
+from time import perf_counter
+
+from paraphrasing.ppdb import PPDB
+
+
+def rss_mb():
+    """
+    :return float: resident set size of this process in MB
+    """
+    with open('/proc/self/statm') as open_file:
+        return int(open_file.read().split()[1]) * resource.getpagesize() / 2 ** 20
+
+
+def lookups(paraphrases, tokens):
+    """
+    :param paraphrases: paraphrasing dictionary
+    :param list tokens: tokens to look up
+    :return int: number of paraphrases found
+    """
+    found = 0
+    for token in tokens:
+        if token in paraphrases:
+            found += len(paraphrases[token])
+    return found
+
+
+def measure(filename, tokens, repeat):
+    """
+    measure one PPDB file in this process
+
+    :param str filename: PPDB file
+    :param list tokens: tokens to look up
+    :param int repeat: number of passes over the tokens
+    :return dict: measurements
+    """
+    rss_before = rss_mb()
+    start = perf_counter()
+    paraphrases = PPDB(filename, 1, 0, 0).paraphrases
+    load = perf_counter() - start
+    rss_loaded = rss_mb()
+
+    start = perf_counter()
+    lookups(paraphrases, tokens)
+    cold = perf_counter() - start
+
+    start = perf_counter()
+    for _ in range(repeat):
+        lookups(paraphrases, tokens)
+    warm = perf_counter() - start
+
+    return {'file': filename, 'load_s': load, 'rss_mb': rss_loaded - rss_before,
+            'cold_lookups_per_s': len(tokens) / cold, 'warm_lookups_per_s': repeat * len(tokens) / warm}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ppdb_benchmark.py')
+
+    parser.add_argument('-files', nargs='+', default=['data/ppdb/ppdb.json', 'data/ppdb/ppdb.ppdb'],
+                        help='PPDB files to compare')
+    parser.add_argument('-tokens', default='data/templates.txt',
+                        help='text file whose words are looked up, e.g. generated questions')
+    parser.add_argument('-repeat', type=int, default=100, help='number of passes over the tokens')
+    parser.add_argument('-measure', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    with open(args.tokens) as open_file:
+        tokens = open_file.read().split()
+    random.seed(0)
+    random.shuffle(tokens)
+
+    if args.measure:
+        print(json.dumps(measure(args.measure, tokens, args.repeat)))
+    else:
+        for filename in args.files:
+            result = json.loads(subprocess.run([sys.executable] + sys.argv + ['-measure', filename],
+                                               capture_output=True, check=True, text=True).stdout)
+            print(f'{result["file"]}: load {result["load_s"]:.2f}s, RSS +{result["rss_mb"]:.1f} MB, '
+                  f'{result["cold_lookups_per_s"]:,.0f} lookups/s cold, '
+                  f'{result["warm_lookups_per_s"]:,.0f} lookups/s warm')
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+""" convert ppdb.json into the compact memory-mapped PPDB format, pruned to the vocabulary generation can produce
+
+Tokens of generated NL queries stem from the templates, the slot filling dictionary, the comparative and superlative
+adjectives and the schema utterances, and with -fill_literals from the values in the DBs. Only PPDB keys found among
+the phrases and word n-grams of these sources are kept. Phrases that only arise once slots are filled are not covered:
+n-grams spanning a filled slot and the text around it, and slot values joined to other text within one token like
+{ENT1}'s or {ENT1}.{COL1}. Paraphrases of such phrases are missing from the pruned file, use -no_prune to keep them.
+"""
+import argparse
+import json
+import logging
+import os
+
+from db.database import Database
+from db.schema import Schema
+from generation.generator_utils import RE_SLOT, read_lines_from_file, parse_dict
+from paraphrasing.compact_ppdb import write_compact
+from query.query_utils import compSuperDict, tokenize_nl
+
+
+def add_phrases(vocabulary, text, max_ngram):
+    """
+    add the phrases of a text with slots to the vocabulary: every text segment between slots, its tokens
+    and its token n-grams
+
+    :param set vocabulary: vocabulary to extend
+    :param str text: text, may contain slots in {}
+    :param int max_ngram: maximum number of tokens of an n-gram
+    """
+
+    for segment in RE_SLOT.split(text):
+        if not segment.strip():
+            continue
+
+        vocabulary.add(segment.strip())
+        tokens = tokenize_nl(segment)
+        for n in range(1, max_ngram + 1):
+            for i in range(0, len(tokens) - n + 1):
+                vocabulary.add(' '.join(tokens[i:i + n]))
+
+
+def generation_vocabulary(args, dbs, tables):
+    """
+    collect the phrases that may occur as tokens of generated NL queries
+
+    :param Namespace args: script arguments
+    :param list dbs: names of the DBs
+    :param list tables: content of the json schema file
+    :return set: vocabulary
+    """
+
+    vocabulary = set()
+
+    for template_line in read_lines_from_file(args.templates):
+        for nl in template_line.split('\t')[:-1]:
+            add_phrases(vocabulary, nl, args.max_ngram)
+
+    for values in list(parse_dict(args.dict).values()) + list(compSuperDict.values()):
+        for value in values:
+            add_phrases(vocabulary, value, args.max_ngram)
+
+    for db in dbs:
+        schema = Schema(f'{args.spider_dir}/schemas/{db}/{db}.schema')
+        for table, default in schema.defaults.items():
+            add_phrases(vocabulary, default['utt'], args.max_ngram)
+            for column in schema.tables[table].values():
+                add_phrases(vocabulary, column['utt'], args.max_ngram)
+
+        if args.literals:
+            database = Database(db, f'{args.spider_dir}/database/{db}', schema, args.json_schema, tables)
+            for literals in database.literals.values():
+                for literal in literals:
+                    # SQL linked literals are cut at the first parenthesis, see Query.replace_values
+                    add_phrases(vocabulary, str(literal), args.max_ngram)
+                    add_phrases(vocabulary, str(literal).split('(')[0], args.max_ngram)
+
+    return vocabulary
+
+
+if __name__ == '__main__':
+    """ read ppdb.json, prune it to the generation vocabulary and write the compact format
+    """
+
+    parser = argparse.ArgumentParser(description='ppdb_compact.py')
+
+    parser.add_argument('-ppdb_file', default='data/ppdb/ppdb.json', help='json file created by ppdb_preprocess.py')
+    parser.add_argument('-out_file', default='data/ppdb/ppdb.ppdb', help='compact PPDB output file')
+    parser.add_argument('-templates', default='data/templates.txt', help='templates file')
+    parser.add_argument('-dict', default='data/slot_filling_dict.txt', help='slot filling dictionary')
+    parser.add_argument('-json_schema', default='data/spider/tables.json', help='path to json file with db schema info')
+    parser.add_argument('-spider_dir', default='data/spider', help='directory with schemas and database directories')
+    parser.add_argument('-db', nargs='+', default=['all'], help="databases whose utterances are kept, 'all' for every "
+                                                                'DB in the json schema file with a schema file')
+    parser.add_argument('-literals', action='store_true', help='keep the values of the DBs, needed for -fill_literals')
+    parser.add_argument('-max_ngram', type=int, default=4, help='maximum number of tokens of kept phrases')
+    parser.add_argument('-no_prune', action='store_true', help='convert the complete PPDB without pruning')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    with open(args.ppdb_file) as open_file:
+        paraphrases = json.load(open_file)
+
+    if not args.no_prune:
+        with open(args.json_schema) as open_file:
+            tables = json.load(open_file)
+
+        dbs = args.db
+        if dbs == ['all']:
+            dbs = [db['db_id'] for db in tables
+                   if os.path.exists(f'{args.spider_dir}/schemas/{db["db_id"]}/{db["db_id"]}.schema')]
+
+        vocabulary = generation_vocabulary(args, dbs, tables)
+        pruned = {key: values for key, values in paraphrases.items() if key in vocabulary}
+        logging.info(f'kept {len(pruned)} of {len(paraphrases)} PPDB keys, vocabulary of {len(vocabulary)} phrases')
+        paraphrases = pruned
+
+    write_compact(paraphrases, args.out_file)
+    logging.info(f'wrote {args.out_file}, {os.path.getsize(args.out_file) / 2 ** 20:.1f} MB')
@@ -1,38 +1,171 @@
 #!/usr/bin/env python3
-""" read a ppdb file and export as json for faster loading
+""" read a ppdb file and export as json or compact PPDB for faster loading
+
+The ppdb file is split into chunks at line boundaries that worker processes parse in parallel.
+Chunks are merged in file order, so the output is the same as reading the file line by line.
 """
 
+import argparse
 import json
+import logging
+import os
+from collections import deque
+from multiprocessing import Pool
+
+from paraphrasing.compact_ppdb import write_compact, COMPACT_EXTENSION
+
+
+def chunk_boundaries(ppdb_file, chunk_size):
+    """
+    split a file into chunks ending at line boundaries
+
+    :param str ppdb_file: path to ppdb file
+    :param int chunk_size: approximate size of a chunk in bytes
+    :return list: (start, end) byte offsets of the chunks
+    """
+
+    size = os.path.getsize(ppdb_file)
+    boundaries = []
+    with open(ppdb_file, 'rb') as open_file:
+        start = 0
+        while start < size:
+            open_file.seek(min(start + chunk_size, size))
+            open_file.readline()
+            end = min(open_file.tell(), size)
+            boundaries.append((start, end))
+            start = end
+
+    return boundaries
+
+
+def accept(columns, min_score, relations):
+    """
+    apply the quality filters to a ppdb rule
+
+    :param list columns: columns of a ppdb line: lhs, phrase, paraphrase, features, alignment, entailment relation
+    :param float min_score: minimum value of the PPDB2.0Score feature, None to keep all scores
+    :param set relations: accepted entailment relations, None to keep all relations
+    :return bool: whether the rule is kept
+    """
+
+    if min_score is not None:
+        features = dict(feature.split('=', 1) for feature in columns[3].split() if '=' in feature)
+        if float(features.get('PPDB2.0Score', '-inf')) < min_score:
+            return False
+
+    if relations is not None and (len(columns) < 6 or columns[5] not in relations):
+        return False
+
+    return True
+
+
+def read_chunk(arguments):
+    """
+    parse a chunk of a ppdb file
 
+    :param tuple arguments: path to ppdb file, start and end offset of the chunk, minimum score, entailment relations
+    :return dict: phrases of the chunk mapped to dicts whose keys are the unique paraphrases in file order
+    """
+
+    ppdb_file, start, end, min_score, relations = arguments
+
+    with open(ppdb_file, 'rb') as open_file:
+        open_file.seek(start)
+        lines = open_file.read(end - start).decode('utf8').splitlines()
+
+    filtered = min_score is not None or relations is not None
+
+    paraphrase_dict = {}
+    for line in lines:
+        columns = line.strip().split(' ||| ')
+        if len(columns) < 3 or filtered and not accept(columns, min_score, relations):
+            continue
+        paraphrase_dict.setdefault(columns[1], {})[columns[2]] = None
 
-def read_ppdb(ppdb_file):
+    return paraphrase_dict
+
+
+def iter_chunks(tasks, processes):
+    """
+    parse chunks in worker processes in file order
+
+    At most one chunk per process is submitted ahead of the chunk being merged, so parsed chunks do not pile up when
+    merging is slower than parsing. The workers are terminated if parsing fails or the caller stops early.
+
+    :param list tasks: arguments of read_chunk
+    :param int processes: number of worker processes, chunks are parsed in this process if it is 1
+    :return generator: parsed chunks
+    """
+
+    if processes <= 1:
+        yield from map(read_chunk, tasks)
+        return
+
+    with Pool(processes) as pool:
+        pending = deque()
+        for task in tasks:
+            if len(pending) == processes:
+                yield pending.popleft().get()
+            pending.append(pool.apply_async(read_chunk, (task,)))
+        while pending:
+            yield pending.popleft().get()
+
+
+def read_ppdb(ppdb_file, processes=1, chunk_size=1 << 26, min_score=None, relations=None):
     """
     read ppdb file and convert into dict look up table with unique value list containing paraphrases
 
+    only the merged result and at most one parsed chunk per process are held in memory
+
     :param str ppdb_file: path to ppdb file
+    :param int processes: number of worker processes
+    :param int chunk_size: approximate size of the chunks in bytes
+    :param float min_score: minimum PPDB2.0Score of a rule, None to keep all scores
+    :param set relations: accepted entailment relations, None to keep all relations
     :return dict: processed content of ppdb file
     """
 
+    tasks = [(ppdb_file, start, end, min_score, relations) for start, end in chunk_boundaries(ppdb_file, chunk_size)]
+
+    # unique paraphrases are kept as dict keys, which are ordered sets
     paraphrase_dict = {}
+    for i, chunk in enumerate(iter_chunks(tasks, processes)):
+        for phrase, paraphrases in chunk.items():
+            if phrase in paraphrase_dict:
+                paraphrase_dict[phrase].update(paraphrases)
+            else:
+                paraphrase_dict[phrase] = paraphrases
+        logging.info(f'read chunk {i + 1} of {len(tasks)}, {len(paraphrase_dict)} phrases')
 
-    with open(ppdb_file) as open_in_file:
-        for line in open_in_file:
-            columns = line.strip().split(' ||| ')
-            paraphrases = paraphrase_dict.setdefault(columns[1], [])
-            if columns[2] not in paraphrases:
-                paraphrases.append(columns[2])
+    for phrase, paraphrases in paraphrase_dict.items():
+        paraphrase_dict[phrase] = list(paraphrases)
 
     return paraphrase_dict
 
 
 if __name__ == '__main__':
-    """ read an original ppdb file under 'in_file' and write json to out_file
+    """ read an original ppdb file under 'in_file' and write json or compact PPDB to out_file
     """
 
-    in_file = '../data/ppdb/ppdb-2.0-s-all'
-    out_file = '../data/ppdb/ppdb.json'
+    parser = argparse.ArgumentParser(description='ppdb_preprocess.py')
+
+    parser.add_argument('-in_file', default='../data/ppdb/ppdb-2.0-s-all', help='original ppdb file')
+    parser.add_argument('-out_file', default='../data/ppdb/ppdb.json',
+                        help=f'output file, written in the compact format if it ends in {COMPACT_EXTENSION}')
+    parser.add_argument('-processes', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('-chunk_size', type=int, default=64, help='size of the chunks parsed by the workers in MB')
+    parser.add_argument('-min_score', type=float, help='minimum PPDB2.0Score of kept paraphrases')
+    parser.add_argument('-relations', nargs='+',
+                        help='kept entailment relations, e.g. Equivalence ForwardEntailment ReverseEntailment')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
 
-    ppdb_dict = read_ppdb(in_file)
+    ppdb_dict = read_ppdb(args.in_file, args.processes, args.chunk_size << 20, args.min_score,
+                          set(args.relations) if args.relations else None)
 
-    with open(out_file, 'w') as open_out_file:
-        json.dump(ppdb_dict, open_out_file, sort_keys=True, indent=4, separators=(',', ': '))
+    if args.out_file.endswith(COMPACT_EXTENSION):
+        write_compact(ppdb_dict, args.out_file)
+    else:
+        with open(args.out_file, 'w') as open_out_file:
+            json.dump(ppdb_dict, open_out_file, sort_keys=True, indent=4, separators=(',', ': '))
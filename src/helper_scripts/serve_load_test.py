@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+""" load test for the sample server: concurrent clients request batches and sustained throughput is reported
+"""
+import argparse
+import asyncio
+from time import perf_counter
+
+from generation.server import request_samples
+
+
+async def run_client(args, seed, deadline):
+    """
+    request batches until the deadline has passed
+
+    :param Namespace args: load test arguments
+    :param int seed: client seed
+    :param float deadline: end of the load test in perf_counter time
+    :return tuple: number of samples and number of batches received
+    """
+    if args.socket:
+        reader, writer = await asyncio.open_unix_connection(args.socket, limit=1 << 24)
+    else:
+        reader, writer = await asyncio.open_connection(args.host, args.port, limit=1 << 24)
+
+    samples = 0
+    batches = 0
+    while perf_counter() < deadline:
+        samples += len(await request_samples(reader, writer, args.batch, seed, args.db))
+        batches += 1
+
+    writer.close()
+    return samples, batches
+
+
+async def load_test(args):
+    """
+    run concurrent clients and print throughput
+
+    :param Namespace args: load test arguments
+    """
+    start = perf_counter()
+    results = await asyncio.gather(*(run_client(args, seed, start + args.duration) for seed in range(args.clients)))
+    elapsed = perf_counter() - start
+
+    for seed, (samples, batches) in enumerate(results):
+        print(f'client {seed}: {samples} samples in {batches} batches, {samples / elapsed:.1f} samples/s')
+
+    total = sum(samples for samples, _ in results)
+    print(f'total: {total} samples in {elapsed:.1f}s, {total / elapsed:.1f} samples/s with {args.clients} clients')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='serve_load_test.py')
+
+    parser.add_argument('-host', default='127.0.0.1', help='host of the sample server')
+    parser.add_argument('-port', type=int, default=8765, help='port of the sample server')
+    parser.add_argument('-socket', help='unix socket of the sample server, used instead of host and port')
+    parser.add_argument('-clients', type=int, default=4, help='number of concurrent clients')
+    parser.add_argument('-batch', type=int, default=64, help='samples per request')
+    parser.add_argument('-duration', type=float, default=30, help='duration of the load test in seconds')
+    parser.add_argument('-db', nargs='+', help='request samples for these DBs only')
+
+    asyncio.run(load_test(parser.parse_args()))
@@ -5,10 +5,9 @@ import json
 from itertools import groupby
 from operator import itemgetter
 
-from nltk import word_tokenize
-
 from db.database import Database
 from query.canonicaliser import make_canonical
+from query.word_tokenizer import word_tokenize
 
 
 def canonicalize_spider_queries(spider_path, queries, out_path, preserve_input=True):
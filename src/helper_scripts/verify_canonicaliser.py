@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+""" verify that the single pass lexer of the canonicaliser matches the original character by character
+implementation on the queries of Spider json files, and compare their run times
+"""
+import argparse
+import json
+import time
+
+from query.canonicaliser import add_semicolon, canonical_tokens, standardise_blank_spaces_reference
+
+
+def spider_queries(spider_files):
+    """
+    read the SQL queries canonicalised by spider_canonicaliser.py
+
+    :param list spider_files: Spider json files
+    :return list: queries with values and with value placeholders
+    """
+
+    queries = []
+    for spider_file in spider_files:
+        with open(spider_file) as open_file:
+            for sample in json.load(open_file):
+                queries.append(sample['query'])
+                queries.append(' '.join(sample['query_toks_no_value']))
+
+    return queries
+
+
+if __name__ == '__main__':
+    """ compare the lexer with the reference implementation on all queries and print differences
+    """
+
+    parser = argparse.ArgumentParser(description='verify_canonicaliser.py')
+
+    parser.add_argument('-spider_files', nargs='+', help='Spider json files',
+                        default=['data/spider/train_spider.json', 'data/spider/train_others.json',
+                                 'data/spider/dev.json'])
+
+    args = parser.parse_args()
+
+    queries = [add_semicolon(query) for query in spider_queries(args.spider_files)]
+
+    start = time.perf_counter()
+    reference = [standardise_blank_spaces_reference(query) for query in queries]
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    lexed = [' '.join(canonical_tokens(query)) for query in queries]
+    lexer_time = time.perf_counter() - start
+
+    differences = 0
+    for query, expected, actual in zip(queries, reference, lexed):
+        if expected != actual:
+            differences += 1
+            print(f'{query}\n  reference: {expected}\n  lexer:     {actual}')
+
+    print(f'{differences} differences in {len(queries)} queries, reference {reference_time:.2f}s, '
+          f'lexer {lexer_time:.2f}s')
+    assert differences == 0, 'lexer does not match the reference implementation'
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+""" verify that the fast word tokenizer matches nltk and the fast SQL tokenizer matches process_sql on the questions
+and queries of Spider json files, and compare their run times
+"""
+import argparse
+import json
+import time
+
+from nltk import word_tokenize as nltk_word_tokenize
+
+from query.word_tokenizer import word_tokenize, tokenize_spider_sql
+from spider.process_sql import tokenize
+
+
+def compare(name, texts, reference, fast):
+    """
+    tokenize texts with both tokenizers and print differences
+
+    :param str name: name of the texts
+    :param list texts: texts to tokenize
+    :param function reference: tokenizer based on nltk
+    :param function fast: fast tokenizer
+    :return int: number of differences
+    """
+
+    start = time.perf_counter()
+    expected = [reference(text) for text in texts]
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    actual = [fast(text) for text in texts]
+    fast_time = time.perf_counter() - start
+
+    differences = 0
+    for text, expected_tokens, actual_tokens in zip(texts, expected, actual):
+        if expected_tokens != actual_tokens:
+            differences += 1
+            print(f'{text}\n  nltk: {expected_tokens}\n  fast: {actual_tokens}')
+
+    print(f'{name}: {differences} differences in {len(texts)} texts, nltk {reference_time:.2f}s, '
+          f'fast {fast_time:.2f}s')
+    return differences
+
+
+if __name__ == '__main__':
+    """ compare the tokenizers with nltk on all questions and queries and print differences
+    """
+
+    parser = argparse.ArgumentParser(description='verify_word_tokenizer.py')
+
+    parser.add_argument('-spider_files', nargs='+', help='Spider json files, e.g. also generated train.json files',
+                        default=['data/spider/train_spider.json', 'data/spider/train_others.json',
+                                 'data/spider/dev.json'])
+
+    args = parser.parse_args()
+
+    questions = []
+    queries = []
+    for spider_file in args.spider_files:
+        with open(spider_file) as open_file:
+            for sample in json.load(open_file):
+                questions.append(sample['question'])
+                queries.append(sample['query'])
+
+    differences = compare('questions', questions, nltk_word_tokenize, word_tokenize)
+    differences += compare('queries', queries, nltk_word_tokenize, word_tokenize)
+    differences += compare('process_sql', queries, tokenize, tokenize_spider_sql)
+
+    assert differences == 0, 'tokenizers do not match nltk'
@@ -0,0 +1,175 @@
+# coding=utf-8
+""" compact binary PPDB format, memory-mapped instead of loaded into python dicts
+
+All processes mapping the same file share one copy of it in the page cache.
+
+layout, all integers little endian:
+    header      magic, format version, number of keys, strings, paraphrase ids and hash table slots
+    offsets     uint64 offset of every string in the string blob, plus the end of the blob
+    lists       uint32 offset of the paraphrase ids of every key, plus the total number of ids; key i is string i
+    ids         uint32 string ids of the paraphrases of all keys
+    table       uint32 open addressing hash table from crc32 of a key to key id + 1, 0 marks an empty slot
+    blob        utf8 encoded strings
+"""
+import mmap
+import os
+import struct
+import sys
+import zlib
+from array import array
+from collections.abc import Mapping
+
+MAGIC = b'PPDB'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<4s5I')
+
+# file extension selecting the compact format in PPDB
+COMPACT_EXTENSION = '.ppdb'
+
+
+def write_compact(paraphrases, filename):
+    """
+    write a paraphrasing dictionary in the compact format; the file is replaced atomically
+
+    :param dict paraphrases: mapping tokens to lists of paraphrases
+    :param str filename: path of the compact PPDB file
+    """
+
+    # keys come first so that key i is string i; paraphrases are stored once no matter how often they occur
+    string_ids = {key: i for i, key in enumerate(paraphrases)}
+    for values in paraphrases.values():
+        for value in values:
+            string_ids.setdefault(value, len(string_ids))
+
+    blob = bytearray()
+    offsets = array('Q', [0])
+    for string in string_ids:
+        blob += string.encode('utf8')
+        offsets.append(len(blob))
+
+    lists = array('I', [0])
+    ids = array('I')
+    for values in paraphrases.values():
+        ids.extend(string_ids[value] for value in values)
+        lists.append(len(ids))
+
+    # power of two with a load factor of at most 0.5
+    table_size = 1 << max(3, (2 * len(paraphrases)).bit_length())
+    table = array('I', bytes(4 * table_size))
+    for key_id, key in enumerate(paraphrases):
+        slot = zlib.crc32(key.encode('utf8')) & (table_size - 1)
+        while table[slot]:
+            slot = (slot + 1) & (table_size - 1)
+        table[slot] = key_id + 1
+
+    if sys.byteorder == 'big':
+        for integers in (offsets, lists, ids, table):
+            integers.byteswap()
+
+    with open(filename + '.tmp', 'wb') as open_file:
+        open_file.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(paraphrases), len(string_ids), len(ids), table_size))
+        for integers in (offsets, lists, ids, table):
+            integers.tofile(open_file)
+        open_file.write(blob)
+    os.replace(filename + '.tmp', filename)
+
+
+class CompactPPDB(Mapping):
+    """
+    read-only paraphrasing dictionary backed by a memory-mapped compact PPDB file
+
+    behaves like the dict loaded from ppdb.json; paraphrase lists are decoded on access
+
+    Attributes:
+        mmap mmap: mapped file
+        memoryview offsets: string offsets into the blob
+        memoryview lists: paraphrase id offsets per key
+        memoryview ids: paraphrase string ids
+        memoryview table: hash table of the keys
+        int size: number of keys
+        int mask: hash table size - 1
+        int blob: start of the string blob in the file
+        dict found: paraphrases of the tokens looked up so far, None for tokens without paraphrases
+    """
+
+    def __init__(self, filename):
+        """
+        map a compact PPDB file
+
+        :param str filename: path of the compact PPDB file
+        """
+
+        assert sys.byteorder == 'little', 'compact PPDB files can only be mapped on little endian machines'
+
+        with open(filename, 'rb') as open_file:
+            self.mmap = mmap.mmap(open_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, self.size, num_strings, num_ids, table_size = HEADER.unpack_from(self.mmap)
+        assert magic == MAGIC and version == FORMAT_VERSION, \
+            f'{filename} is not a compact PPDB file of format version {FORMAT_VERSION}'
+
+        view = memoryview(self.mmap)
+        start = HEADER.size
+        sections = []
+        for item_size, count, typecode in ((8, num_strings + 1, 'Q'), (4, self.size + 1, 'I'), (4, num_ids, 'I'),
+                                           (4, table_size, 'I')):
+            sections.append(view[start:start + item_size * count].cast(typecode))
+            start += item_size * count
+        self.offsets, self.lists, self.ids, self.table = sections
+
+        self.mask = table_size - 1
+        self.blob = start
+        self.found = {}
+
+    def string(self, string_id):
+        """
+        :param int string_id: index of the string
+        :return str: decoded string
+        """
+        return self.mmap[self.blob + self.offsets[string_id]:self.blob + self.offsets[string_id + 1]].decode('utf8')
+
+    def find(self, key):
+        """
+        look up the paraphrases of a key; results are memorized since only few distinct tokens are paraphrased
+
+        :param str key: token
+        :return list: paraphrases, None if the token has none
+        """
+
+        if key in self.found:
+            return self.found[key]
+
+        encoded = key.encode('utf8')
+        slot = zlib.crc32(encoded) & self.mask
+        paraphrases = None
+        while self.table[slot]:
+            key_id = self.table[slot] - 1
+            if self.mmap[self.blob + self.offsets[key_id]:self.blob + self.offsets[key_id + 1]] == encoded:
+                string_ids = self.ids[self.lists[key_id]:self.lists[key_id + 1]]
+                paraphrases = [self.string(string_id) for string_id in string_ids]
+                break
+            slot = (slot + 1) & self.mask
+
+        self.found[key] = paraphrases
+        return paraphrases
+
+    def __contains__(self, key):
+        # memorized tokens are answered without a further call, membership is tested for every token of a query
+        paraphrases = self.found.get(key, False)
+        if paraphrases is False:
+            paraphrases = self.find(key) if isinstance(key, str) else None
+
+        return paraphrases is not None
+
+    def __getitem__(self, key):
+        paraphrases = self.find(key) if isinstance(key, str) else None
+        if paraphrases is None:
+            raise KeyError(key)
+
+        return paraphrases
+
+    def __iter__(self):
+        return (self.string(key_id) for key_id in range(self.size))
+
+    def __len__(self):
+        return self.size
@@ -1,33 +1,330 @@
 # coding=utf-8
 import argparse
+import asyncio
 import json
+import random
+import sys
+import threading
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from itertools import islice
 
 import requests
 from nltk.translate.bleu_score import sentence_bleu
 
+from paraphrasing.translation_cache import TranslationCache
+
 # TODO
 URL = ''
 API_KEY = ''
+# part of the translation cache key, change when switching to a translation API with different results
+API_VERSION = 'google-v2'
+
+# HTTP status codes after which a request is retried
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+# maximum number of batches buffered in streaming per request in flight
+STREAM_BUFFER = 16
 
 
 # Please note that there is no input checking for language codes.
 # Full list of supported languages can be found at https://cloud.google.com/translate/docs/languages
 
+def ngramOverlap(reference, hypothesis, n=2):
+    """
+    cheap alternative to BLEU: mean F1 of the shared n-grams up to length n
+
+    :param list reference: tokens of the query
+    :param list hypothesis: tokens of the paraphrase
+    :param int n: maximum n-gram length
+    :return float: overlap between 0 and 1
+    """
+    scores = []
+    for k in range(1, n + 1):
+        reference_ngrams = Counter(tuple(reference[i:i + k]) for i in range(len(reference) - k + 1))
+        hypothesis_ngrams = Counter(tuple(hypothesis[i:i + k]) for i in range(len(hypothesis) - k + 1))
+        total = sum(reference_ngrams.values()) + sum(hypothesis_ngrams.values())
+        scores.append(2 * sum((reference_ngrams & hypothesis_ngrams).values()) / total if total else 0.0)
+
+    return sum(scores) / n
+
+
+def scorePairs(pairs, metric):
+    """
+    score paraphrases against their queries; executed by worker processes
+
+    :param list pairs: (query, paraphrase) tuples
+    :param str metric: 'bleu' for sentence BLEU, 'overlap' for the cheaper ngramOverlap
+    :return list: scores in the order of the pairs
+    """
+    if metric == 'bleu':
+        return [sentence_bleu([query.split(' ')], paraphrase.split(' ')) for query, paraphrase in pairs]
+    return [ngramOverlap(query.split(' '), paraphrase.split(' ')) for query, paraphrase in pairs]
+
+
 class PivotParaphraser:
-    def __init__(self):
-        pass
+    """
+    Paraphraser translating queries through a chain of pivot languages
+
+    Files are translated in batches of queries per request, with a bounded number of requests in flight.
+
+    Attributes:
+        str url: translation API endpoint
+        str apiKey: translation API key
+        int batchSize: number of queries per request
+        int maxInFlight: maximum number of concurrent requests
+        int retries: number of retries of a failed request
+        float backoff: delay before the first retry in seconds, doubled for every further retry
+        str source: language of the queries
+        TranslationCache cache: persistent translation cache, None to translate everything
+    """
+
+    def __init__(self, url=URL, apiKey=API_KEY, batchSize=64, maxInFlight=8, retries=5, backoff=0.5, source='en',
+                 cache=None):
+        self.url = url
+        self.apiKey = apiKey
+        self.batchSize = batchSize
+        self.maxInFlight = maxInFlight
+        self.retries = retries
+        self.backoff = backoff
+        self.source = source
+        self.cache = cache
+
+        self.sessions = threading.local()
 
     def executeRequest(self, query, language):
-        params = {'q': query, 'target': language, 'key': API_KEY}
-        r = requests.post(url=URL, data=params)
+        params = {'q': query, 'target': language, 'key': self.apiKey}
+        r = requests.post(url=self.url, data=params)
         return r.text
 
+    def executeBatchRequest(self, queries, language):
+        """
+        translate several queries with one blocking request; every thread keeps its connection alive
+
+        :param list queries: queries to translate
+        :param str language: target language
+        :return list: translations in the order of the queries
+        """
+        if not hasattr(self.sessions, 'session'):
+            self.sessions.session = requests.Session()
+
+        params = [('q', query) for query in queries] + [('target', language), ('key', self.apiKey)]
+        r = self.sessions.session.post(url=self.url, data=params, timeout=60)
+        r.raise_for_status()
+
+        translations = r.json()['data']['translations']
+        assert len(translations) == len(queries), f'{len(translations)} translations for {len(queries)} queries'
+        return [translation['translatedText'] for translation in translations]
+
+    async def requestBatch(self, queries, language, semaphore, executor):
+        """
+        request the translations of a batch of queries, retrying with exponential backoff
+
+        :param list queries: queries to translate
+        :param str language: target language
+        :param Semaphore semaphore: bounds the requests in flight
+        :param ThreadPoolExecutor executor: threads executing the blocking requests
+        :return list: translations in the order of the queries
+        """
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            async with semaphore:
+                try:
+                    return await loop.run_in_executor(executor, self.executeBatchRequest, queries, language)
+                except requests.HTTPError as e:
+                    if e.response.status_code not in RETRY_STATUS or attempt == self.retries:
+                        raise
+                except (requests.ConnectionError, requests.Timeout):
+                    if attempt == self.retries:
+                        raise
+
+            # jitter keeps clients that failed together from retrying together
+            await asyncio.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+
+    async def translateBatch(self, queries, source, language, semaphore, executor):
+        """
+        translate a batch of queries; only distinct queries missing from the cache are requested
+
+        :param list queries: queries to translate
+        :param str source: language of the queries
+        :param str language: target language
+        :param Semaphore semaphore: bounds the requests in flight
+        :param ThreadPoolExecutor executor: threads executing the blocking requests
+        :return list: translations in the order of the queries
+        """
+        translations = self.cache.get_many(queries, source, language) if self.cache else {}
+
+        missing = [query for query in dict.fromkeys(queries) if query not in translations]
+        if missing:
+            requested = dict(zip(missing, await self.requestBatch(missing, language, semaphore, executor)))
+            if self.cache:
+                self.cache.put_many(requested, source, language)
+            translations.update(requested)
+
+        return [translations[query] for query in queries]
+
+    async def translateChain(self, queries, languages, semaphore, executor):
+        """
+        :param list queries: queries to translate
+        :param list languages: pivot languages, the last one is the output language
+        :param Semaphore semaphore: bounds the requests in flight
+        :param ThreadPoolExecutor executor: threads executing the blocking requests
+        :return list: translations through all languages in the order of the queries
+        """
+        source = self.source
+        for lang in languages:
+            queries = await self.translateBatch(queries, source, lang, semaphore, executor)
+            source = lang
+        return queries
+
+    async def fanOutBatch(self, queries, trie, chains, semaphore, executor):
+        """
+        translate a batch of queries through several chains concurrently; chains sharing a prefix translate it once
+
+        :param list queries: queries to translate
+        :param dict trie: prefix trie of the chains, mapping languages to the trie of the following hops
+        :param list chains: chains as tuples of languages
+        :param Semaphore semaphore: bounds the requests in flight
+        :param ThreadPoolExecutor executor: threads executing the blocking requests
+        :return dict: translations in the order of the queries per chain
+        """
+        results = {}
+
+        async def descend(translations, source, node, prefix):
+            if prefix in chains:
+                results[prefix] = translations
+            await asyncio.gather(*(hop(translations, source, lang, children, prefix)
+                                   for lang, children in node.items()))
+
+        async def hop(translations, source, lang, children, prefix):
+            translated = await self.translateBatch(translations, source, lang, semaphore, executor)
+            await descend(translated, lang, children, prefix + (lang,))
+
+        await descend(queries, self.source, trie, ())
+        return results
+
+    async def fanOutAll(self, queries, chains, semaphore, executor):
+        """
+        paraphrase queries through several chains of languages in concurrent batches
+
+        :param list queries: queries to translate
+        :param list chains: chains as tuples of languages
+        :param Semaphore semaphore: bounds the requests in flight
+        :param ThreadPoolExecutor executor: threads executing the blocking requests
+        :return list: for each query its distinct paraphrases with the chains producing them, in order of the chains
+        """
+        trie = {}
+        for chain in chains:
+            node = trie
+            for lang in chain:
+                node = node.setdefault(lang, {})
+
+        batches = [queries[i:i + self.batchSize] for i in range(0, len(queries), self.batchSize)]
+        translated = await asyncio.gather(*(self.fanOutBatch(batch, trie, chains, semaphore, executor)
+                                            for batch in batches))
+
+        paraphrases = []
+        for batch, translations in zip(batches, translated):
+            for i, query in enumerate(batch):
+                # translations back to the original query are no paraphrases
+                provenance = {}
+                for chain in chains:
+                    if translations[chain][i] != query:
+                        provenance.setdefault(translations[chain][i], []).append('|'.join(chain))
+                paraphrases.append([{'text': text, 'chains': names} for text, names in provenance.items()])
+
+        return paraphrases
+
+    async def streamBatches(self, inF, process, write):
+        """
+        process the lines of a file in batches, reading lazily and writing results in input order
+
+        Up to twice maxInFlight batches are processed concurrently, so later batches are translated while earlier
+        ones are scored. Finished batches wait for slower earlier ones (e.g. retried requests) to be written in order;
+        reading pauses when too many of them are buffered, which bounds memory.
+
+        :param inF: open input file with one query per line
+        :param process: coroutine function processing a batch of queries
+        :param write: function called with every batch and its result, in input order
+        :return int: number of queries
+        """
+        pending = deque()
+        active = set()
+        total_lines = 0
+        while True:
+            while len(active) < 2 * self.maxInFlight and len(pending) < STREAM_BUFFER * self.maxInFlight:
+                batch = [line.rstrip('\n') for line in islice(inF, self.batchSize)]
+                if not batch:
+                    break
+                task = asyncio.ensure_future(process(batch))
+                pending.append((batch, task))
+                active.add(task)
+                total_lines += len(batch)
+
+            while pending and pending[0][1].done():
+                batch, task = pending.popleft()
+                write(batch, task.result())
+
+            if not pending:
+                return total_lines
+
+            done, _ = await asyncio.wait(active, return_when=asyncio.FIRST_COMPLETED)
+            active -= done
+
+    async def fanOutStream(self, inF, outF, chains):
+        """
+        paraphrase the lines of a file through several chains
+
+        :param inF: open input file with one query per line
+        :param outF: open output file, receives one json object per query
+        :param list chains: chains as tuples of languages
+        :return int: number of queries
+        """
+        semaphore = asyncio.Semaphore(self.maxInFlight)
+
+        def write(queries, paraphrases):
+            for query, query_paraphrases in zip(queries, paraphrases):
+                outF.write(json.dumps({'query': query, 'paraphrases': query_paraphrases}) + '\n')
+
+        with ThreadPoolExecutor(max_workers=self.maxInFlight) as executor:
+            return await self.streamBatches(inF, lambda batch: self.fanOutAll(batch, chains, semaphore, executor),
+                                            write)
+
+    def fanOutFile(self, inFile, outFile, chains):
+        """
+        paraphrase a file through several chains and write json lines with the paraphrases of each query
+
+        :param str inFile: file with one query per line
+        :param str outFile: output file, standard output if empty
+        :param list chains: chains as lists of languages
+        """
+        chains = list(dict.fromkeys(tuple(chain) for chain in chains))
+        with open(inFile) as inF:
+            if outFile == '':
+                total_lines = asyncio.run(self.fanOutStream(inF, sys.stdout, chains))
+            else:
+                with open(outFile, 'w') as outF:
+                    total_lines = asyncio.run(self.fanOutStream(inF, outF, chains))
+
+        print(total_lines, file=sys.stderr)
+        if self.cache:
+            print(self.cache.statistics(), file=sys.stderr)
+
     def singleTranslation(self, query, languages, file):
         cur_query = query
+        source = self.source
         for lang in languages:
-            response = self.executeRequest(cur_query, lang)
-            json_response = json.loads(response)
-            cur_query = json_response['data']['translations'][0]['translatedText']
+            cached = self.cache.get_many([cur_query], source, lang) if self.cache else {}
+            if cur_query in cached:
+                cur_query = cached[cur_query]
+            else:
+                response = self.executeRequest(cur_query, lang)
+                json_response = json.loads(response)
+                translation = json_response['data']['translations'][0]['translatedText']
+                if self.cache:
+                    self.cache.put_many({cur_query: translation}, source, lang)
+                cur_query = translation
+            source = lang
         if (file == ''):
             print(cur_query)
         else:
@@ -37,27 +334,63 @@ class PivotParaphraser:
             file.write(formatted + newlineFormat)
             return cur_query
 
-    def fileTranslation(self, inFile, outFile, languages):
-        inF = open(inFile, "r")
-        if (inF.mode == 'r'):
-            lines = inF.readlines()
-
-            # no error checking for out file
-            # count = 0
-            total_lines = 0
-            outF = open(outFile, "wb+") if outFile != '' else ''
-            for line in lines:
-                total_lines += 1
-                returned = self.singleTranslation(line, languages, outF)
-                # if (line == returned):
-                #     count += 1
-                score = sentence_bleu([line.split(' ')], returned.split(' '))
-                print(score)
-            # print(count / total_lines)
-            print(total_lines)
-        else:
-            print('cannot open inFile')
-            exit(1)
+    async def translateStream(self, inF, languages, metric, scorer, write):
+        """
+        translate the lines of a file through a chain of languages and score the paraphrases in worker processes
+
+        :param inF: open input file with one query per line
+        :param list languages: pivot languages, the last one is the output language
+        :param str metric: score of the paraphrases, see scorePairs
+        :param ProcessPoolExecutor scorer: worker processes scoring the paraphrases
+        :param write: function called with the (query, paraphrase) pairs and scores of each batch, in order
+        :return int: number of queries
+        """
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.maxInFlight)
+
+        with ThreadPoolExecutor(max_workers=self.maxInFlight) as executor:
+            async def process(queries):
+                pairs = list(zip(queries, await self.translateChain(queries, languages, semaphore, executor)))
+                return pairs, await loop.run_in_executor(scorer, scorePairs, pairs, metric)
+
+            return await self.streamBatches(inF, process, lambda queries, result: write(*result))
+
+    def fileTranslation(self, inFile, outFile, languages, metric='bleu', minScore=None, maxScore=None, workers=None):
+        """
+        translate a file through a chain of languages and score the paraphrases
+
+        An outFile ending in .jsonl receives a json object with query, paraphrase and score per line, restricted to
+        paraphrases scoring between minScore and maxScore. Otherwise the paraphrases are written line by line and
+        the scores printed.
+
+        :param str inFile: file with one query per line
+        :param str outFile: output file, standard output if empty
+        :param list languages: pivot languages, the last one is the output language
+        :param str metric: score of the paraphrases, see scorePairs
+        :param float minScore: minimum score of paraphrases written to .jsonl, None for no minimum
+        :param float maxScore: maximum score of paraphrases written to .jsonl, None for no maximum
+        :param int workers: number of processes scoring paraphrases, number of CPUs if None
+        """
+        jsonl = outFile.endswith('.jsonl')
+        outF = open(outFile, 'w') if outFile != '' else sys.stdout
+
+        def write(pairs, scores):
+            for (query, returned), score in zip(pairs, scores):
+                if not jsonl:
+                    outF.write(returned + '\n')
+                    print(score)
+                elif (minScore is None or score >= minScore) and (maxScore is None or score <= maxScore):
+                    outF.write(json.dumps({'query': query, 'paraphrase': returned, 'score': score}) + '\n')
+
+        with open(inFile) as inF, ProcessPoolExecutor(max_workers=workers) as scorer:
+            total_lines = asyncio.run(self.translateStream(inF, languages, metric, scorer, write))
+
+        if outF is not sys.stdout:
+            outF.close()
+
+        print(total_lines)
+        if self.cache:
+            print(self.cache.statistics())
 
 
 if __name__ == '__main__':
@@ -66,10 +399,33 @@ if __name__ == '__main__':
                         help='single query translation, enclose with quotes. use this OR --inFile')
     parser.add_argument('--lang', action='store', dest='lang', default='en',
                         help='languages to translate, separated with |, encased in quotes . last language is output language')
+    parser.add_argument('--chains', action='store', dest='chains', nargs='+', default=[],
+                        help="several language chains like --lang, e.g. 'de|en' 'fr|en' 'de|fr|en'. paraphrases "
+                             '--inFile through all chains, writes json lines with the distinct paraphrases per query')
     parser.add_argument('--inFile', action='store', dest='inFile', default='',
                         help='read in list of queries to translate. use this OR --query')
     parser.add_argument('--outFile', action='store', dest='outFile', default='',
                         help='write output to file, only to be used with --inFile')
+    parser.add_argument('--url', action='store', dest='url', default=URL,
+                        help='translation API endpoint, e.g. of helper_scripts/mock_translation_server.py')
+    parser.add_argument('--key', action='store', dest='key', default=API_KEY, help='translation API key')
+    parser.add_argument('--batchSize', action='store', dest='batchSize', type=int, default=64,
+                        help='number of queries per request in file translation')
+    parser.add_argument('--maxInFlight', action='store', dest='maxInFlight', type=int, default=8,
+                        help='maximum number of concurrent requests in file translation')
+    parser.add_argument('--source', action='store', dest='source', default='en', help='language of the queries')
+    parser.add_argument('--metric', action='store', dest='metric', choices=['bleu', 'overlap'], default='bleu',
+                        help='paraphrase score in file translation, overlap is a cheaper n-gram F1')
+    parser.add_argument('--minScore', action='store', dest='minScore', type=float,
+                        help='only write paraphrases scoring at least this much to a .jsonl outFile')
+    parser.add_argument('--maxScore', action='store', dest='maxScore', type=float,
+                        help='only write paraphrases scoring at most this much to a .jsonl outFile to drop copies')
+    parser.add_argument('--workers', action='store', dest='workers', type=int,
+                        help='number of processes scoring paraphrases, number of CPUs by default')
+    parser.add_argument('--cache', action='store', dest='cache', default='',
+                        help='sqlite file caching translations across runs')
+    parser.add_argument('--cacheSize', action='store', dest='cacheSize', type=int, default=100000,
+                        help='number of translations of the cache kept in memory')
 
     args = parser.parse_args()
 
@@ -88,8 +444,17 @@ if __name__ == '__main__':
         exit(1)
 
     lang_list = lang.split('|')
-    p = PivotParaphraser()
-    if (query != ''):  # single translation
+    cache = TranslationCache(args.cache, API_VERSION, args.cacheSize) if args.cache else None
+    p = PivotParaphraser(args.url, args.key, args.batchSize, args.maxInFlight, source=args.source, cache=cache)
+    if (args.chains and inFile == ''):
+        print('--chains requires --inFile')
+        exit(1)
+
+    if (args.chains):  # multi pivot file paraphrasing
+        p.fanOutFile(inFile, outFile, [chain.split('|') for chain in args.chains])
+    elif (query != ''):  # single translation
         p.singleTranslation(query, lang_list, '')
     else:  # file translation
-        p.fileTranslation(inFile, outFile, lang_list)
+        p.fileTranslation(inFile, outFile, lang_list, args.metric, args.minScore, args.maxScore, args.workers)
+    if cache:
+        cache.close()
@@ -6,6 +6,10 @@ import logging
 import random
 from copy import copy
 
+import numpy as np
+
+from paraphrasing.compact_ppdb import CompactPPDB, COMPACT_EXTENSION
+
 
 # TODO other paraphrasing methods
 # TODO intelligent selection for training data (crowd sourcing? quality heuristic?)
@@ -22,8 +26,9 @@ class PPDB:
         int rand_drop_scale: random word drop scale
         float rand_drop_p: random drop probability per token
         int scale: paraphrasing scale
-        dict paraphrases: paraphrasing dictionary
+        dict paraphrases: paraphrasing dictionary, a memory-mapped CompactPPDB for compact PPDB files
         dict position: for previously paraphrased tokens saves the index of the next paraphrase
+        dict order: for previously paraphrased tokens saves the shuffled order of its paraphrases
 
     """
 
@@ -31,7 +36,7 @@ class PPDB:
         """
         create PPDB paraphraser object
 
-        :param str filename: path to PPDB file
+        :param str filename: path to PPDB file, either json or compact format (.ppdb)
         :param int scale: paraphrasing scale
         :param int rand_drop_scale: random word drop scale
         :param float rand_drop_p: random drop probability
@@ -43,8 +48,13 @@ class PPDB:
 
         self.paraphrases = {}
         self.position = {}
+        self.order = {}
+
+        if self.scale > 0 and filename.endswith(COMPACT_EXTENSION):
+            self.paraphrases = CompactPPDB(filename)
 
-        if self.scale > 0:  # No need if pp_scale is 0 = paraphrasing disabled
+            logging.info('PPDB paraphrases mapped!')
+        elif self.scale > 0:  # No need if pp_scale is 0 = paraphrasing disabled
             with open(filename) as open_file:
                 self.paraphrases = json.load(open_file)
 
@@ -52,6 +62,24 @@ class PPDB:
         else:
             logging.info('Paraphrasing disabled')
 
+    def reset(self):
+        """
+        forget the paraphrases used so far, so that subsequent paraphrasing does not depend on previous calls
+        """
+
+        self.position = {}
+        self.order = {}
+
+    def get_paraphrasable_positions(self, tokens):
+        """
+        determines the positions of the tokens that could be paraphrased with the dictionary
+
+        :param list tokens: list of tokens of a NL query
+        :return list: indices of the tokens available in the paraphrasing dictionary
+        """
+
+        return [i for i, t in enumerate(tokens) if t in self.paraphrases]
+
     def get_candidate_count(self, tokens):
         """
         determines the number of tokens that could be paraphrased with the dictionary
@@ -60,47 +88,45 @@ class PPDB:
         :return int: number of tokens in the list available in the paraphrasing dictionary
         """
 
-        count = 0
-        for t in tokens:
-            if t in self.paraphrases:
-                count += 1
-
-        return count
+        return len(self.get_paraphrasable_positions(tokens))
 
-    def get_substitution_paraphrase(self, tokens):
+    def next_paraphrase(self, token, shuffle):
         """
-        generate paraphrase by randomly substituting one token with one of its paraphrases
+        use all available paraphrases for a token before reusing one
 
-        :param list tokens: list of tokens of a NL query
-        :return list: list of tokens of a paraphrase of the NL query
+        :param str token: token available in the paraphrasing dictionary
+        :param shuffle: function shuffling a list in place, used for the order of a token chosen for the first time
+        :return str: next paraphrase of the token
         """
 
-        num_candidates = self.get_candidate_count(tokens)
-
-        if not num_candidates:
-            return None
+        # token chosen for the first time; shuffle a copy to leave the paraphrasing dictionary intact
+        if token not in self.position:
+            self.order[token] = copy(self.paraphrases[token])
+            shuffle(self.order[token])
+            self.position[token] = 0
 
-        random_index = random.randint(0, num_candidates - 1)
-        paraphrasable_index = -1
+        old_position = self.position[token]
+        self.position[token] = (old_position + 1) % len(self.order[token])
 
-        for i in range(0, len(tokens)):
-            if tokens[i] in self.paraphrases:
+        return self.order[token][old_position]
 
-                paraphrasable_index += 1
+    def get_substitution_paraphrase(self, tokens, positions=None):
+        """
+        generate paraphrase by randomly substituting one token with one of its paraphrases
 
-                # use all available paraphrases for a token before reusing
-                if paraphrasable_index == random_index:
+        :param list tokens: list of tokens of a NL query
+        :param list positions: paraphrasable positions of the tokens, determined if not given
+        :return list: list of tokens of a paraphrase of the NL query
+        """
 
-                    # token chosen for the first time
-                    if not tokens[i] in self.position:
-                        random.shuffle(self.paraphrases[tokens[i]])
-                        self.position[tokens[i]] = 0
+        if positions is None:
+            positions = self.get_paraphrasable_positions(tokens)
 
-                    old_position = self.position[tokens[i]]
-                    self.position[tokens[i]] = (self.position[tokens[i]] + 1) % len(self.paraphrases[tokens[i]])
-                    tokens[i] = self.paraphrases[tokens[i]][old_position]  # actual paraphrasing
+        if not positions:
+            return None
 
-                    break
+        i = positions[random.randint(0, len(positions) - 1)]
+        tokens[i] = self.next_paraphrase(tokens[i], random.shuffle)  # actual paraphrasing
 
         return tokens
 
@@ -109,15 +135,16 @@ class PPDB:
         generate paraphrases for a NL token list
 
         :param list tokens: list of tokens of a NL query
-        :return:
+        :return list: paraphrases, the original phrase first
         """
 
         # trivial paraphrase; original phrase
         paraphrase_tokens = [tokens]
 
         # generate paraphrases by substituting with paraphrasing dictionary
+        positions = self.get_paraphrasable_positions(tokens) if self.scale else []
         for i in range(0, self.scale):
-            paraphrase = self.get_substitution_paraphrase(copy(tokens))
+            paraphrase = self.get_substitution_paraphrase(copy(tokens), positions)
             if paraphrase:
                 paraphrase_tokens.append(paraphrase)
 
@@ -137,3 +164,61 @@ class PPDB:
                     paraphrases.append(' '.join(paraphrase))
 
         return paraphrases
+
+    def get_paraphrases_batch(self, token_lists, rng=np.random):
+        """
+        generate paraphrases for many NL token lists at once
+
+        Paraphrases are generated like in get_paraphrases, sharing the round robin order of the paraphrases of each
+        token, but all random draws come from vectorized calls to a NumPy random generator. The result is therefore
+        reproducible through the NumPy seed, but differs from calling get_paraphrases for each token list.
+
+        :param list token_lists: lists of tokens of NL queries
+        :param rng: NumPy random generator (numpy.random.Generator or the numpy.random module)
+        :return list: paraphrases for each token list, the original phrase first
+        """
+
+        # substitution paraphrases; positions of substituted tokens are drawn for all queries at once
+        variants = []
+        draws = rng.random((len(token_lists), self.scale)).tolist()
+        for tokens, query_draws in zip(token_lists, draws):
+            variants.append([tokens])
+            positions = self.get_paraphrasable_positions(tokens) if self.scale else []
+            if not positions:
+                continue
+
+            for draw in query_draws:
+                paraphrase = list(tokens)
+                i = positions[int(draw * len(positions))]
+                paraphrase[i] = self.next_paraphrase(paraphrase[i], rng.shuffle)
+                variants[-1].append(paraphrase)
+
+        flat_variants = [variant for query_variants in variants for variant in query_variants]
+
+        # random drops; a random sample of tokens consists of the tokens with the smallest random keys,
+        # padding gets infinite keys and is never sampled before all tokens of a variant
+        drop_positions = [[] for _ in flat_variants]
+        if self.rand_drop_scale and flat_variants:
+            lengths = np.array([len(variant) for variant in flat_variants])
+            keys = rng.random((len(flat_variants), max(lengths.max(), self.rand_drop_scale)))
+            keys[np.arange(keys.shape[1]) >= lengths[:, None]] = np.inf
+            samples = np.argsort(keys, axis=1, kind='stable')[:, :self.rand_drop_scale]
+            drops = rng.random(samples.shape) <= self.rand_drop_p
+            drop_positions = np.where(drops & (samples < lengths[:, None]), samples, -1).tolist()
+
+        paraphrases = []
+        row = 0
+        for query_variants in variants:
+            paraphrases.append([])
+            for original in query_variants:
+                paraphrases[-1].append(' '.join(original))
+                for index in drop_positions[row]:
+                    if index < 0:
+                        continue
+
+                    # like list.remove, drop the first occurrence of the sampled token
+                    index = original.index(original[index])
+                    paraphrases[-1].append(' '.join(original[:index] + original[index + 1:]))
+                row += 1
+
+        return paraphrases
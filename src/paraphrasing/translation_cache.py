@@ -0,0 +1,133 @@
+# coding=utf-8
+""" persistent cache of translations for pivot paraphrasing
+"""
+import sqlite3
+from collections import OrderedDict
+
+# maximum number of parameters of a single sqlite statement
+SQLITE_MAX_PARAMETERS = 900
+
+
+class TranslationCache:
+    """
+    translations stored in a sqlite file, fronted by an in-memory LRU cache
+
+    Entries are keyed by source text, source language, target language and API version, so reruns and overlapping
+    sweeps only translate new text.
+
+    Attributes:
+        str filename: path of the sqlite file
+        str version: API version, translations of other versions are not used
+        int capacity: maximum number of entries in memory
+        Connection connection: sqlite connection
+        OrderedDict memory: recently used translations, least recently used first
+        int memory_hits: number of lookups answered from memory
+        int disk_hits: number of lookups answered from the sqlite file
+        int misses: number of lookups not in the cache
+    """
+
+    def __init__(self, filename, version, capacity=100000):
+        """
+        open or create a translation cache
+
+        :param str filename: path of the sqlite file
+        :param str version: API version
+        :param int capacity: maximum number of entries in memory
+        """
+        self.filename = filename
+        self.version = version
+        self.capacity = capacity
+
+        self.connection = sqlite3.connect(filename)
+        # write ahead logging lets several runs share one cache file
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS translations (text TEXT, source TEXT, target TEXT, '
+                                'version TEXT, translation TEXT, PRIMARY KEY (text, source, target, version)) '
+                                'WITHOUT ROWID')
+
+        self.memory = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def remember(self, key, translation):
+        """
+        add a translation to the LRU cache, evicting the least recently used ones
+
+        :param tuple key: text, source and target language
+        :param str translation: translation
+        """
+        self.memory[key] = translation
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def get_many(self, texts, source, target):
+        """
+        look up the translations of several texts
+
+        :param list texts: texts to translate
+        :param str source: source language
+        :param str target: target language
+        :return dict: translations of the cached texts; statistics count every distinct text once
+        """
+        unique = list(dict.fromkeys(texts))
+        found = {}
+        missing = []
+        for text in unique:
+            key = (text, source, target)
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                found[text] = self.memory[key]
+            else:
+                missing.append(text)
+        self.memory_hits += len(found)
+
+        for i in range(0, len(missing), SQLITE_MAX_PARAMETERS):
+            chunk = missing[i:i + SQLITE_MAX_PARAMETERS]
+            rows = self.connection.execute(f'SELECT text, translation FROM translations WHERE source = ? AND '
+                                           f'target = ? AND version = ? AND text IN ({",".join("?" * len(chunk))})',
+                                           [source, target, self.version] + chunk)
+            for text, translation in rows:
+                found[text] = translation
+                self.remember((text, source, target), translation)
+                self.disk_hits += 1
+
+        self.misses += len(unique) - len(found)
+        return found
+
+    def put_many(self, translations, source, target):
+        """
+        store translations
+
+        :param dict translations: mapping texts to their translations
+        :param str source: source language
+        :param str target: target language
+        """
+        with self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO translations VALUES (?, ?, ?, ?, ?)',
+                                        [(text, source, target, self.version, translation)
+                                         for text, translation in translations.items()])
+
+        for text, translation in translations.items():
+            self.remember((text, source, target), translation)
+
+    def hit_rate(self):
+        """
+        :return float: share of lookups answered from the cache
+        """
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+
+    def statistics(self):
+        """
+        :return str: hit rate and number of hits and misses
+        """
+        return (f'translation cache hit rate {self.hit_rate():.1%}: {self.memory_hits} memory hits, '
+                f'{self.disk_hits} disk hits, {self.misses} misses')
+
+    def close(self):
+        """
+        close the sqlite file
+        """
+        self.connection.close()
@@ -0,0 +1,142 @@
+# coding=utf-8
+""" LRU cache of canonical SQL queries and their spider labels, keyed by the SQL skeleton
+"""
+import re
+import time
+from collections import OrderedDict
+
+# literals that canonicalisation and spider parsing treat like any other single quoted token: without blank spaces,
+# quotes and parentheses, and without @, which would be taken for a placeholder
+RE_PLAIN_LITERAL = re.compile(r'"[^\s"\'()@]+"')
+
+# sentinels are ordered by their digit, so at most ten distinct literals can be masked
+MAX_LITERALS = 10
+
+
+def skeleton(sql):
+    """
+    mask the literals of a query with sentinels that compare like the literals
+
+    Canonicalisation only compares literals with each other, for equality and when sorting, so the canonical form of
+    the skeleton is that of the query with the sentinels in place of the literals. The i-th smallest literal becomes
+    "var<i>".
+
+    :param str sql: SQL query with tokens separated by blank spaces
+    :return tuple: skeleton and dict mapping sentinels to literals, None if a literal cannot be masked
+    """
+    if "'" in sql:
+        return None
+
+    tokens = sql.split(' ')
+    literals = sorted({token for token in tokens if '"' in token})
+    if len(literals) > MAX_LITERALS or not all(RE_PLAIN_LITERAL.fullmatch(literal) for literal in literals):
+        return None
+
+    sentinels = {literal: f'"var{i}"' for i, literal in enumerate(literals)}
+    return ' '.join(sentinels.get(token, token) for token in tokens), {s: l for l, s in sentinels.items()}
+
+
+def substitute(label, literals):
+    """
+    copy a parsed spider label, replacing sentinel values with literals
+
+    :param label: parsed SQL or part of it
+    :param dict literals: literals by sentinel
+    :return: copy of the label
+    """
+    if isinstance(label, dict):
+        return {key: substitute(value, literals) for key, value in label.items()}
+    if isinstance(label, list):
+        return [substitute(value, literals) for value in label]
+    if isinstance(label, tuple):
+        return tuple(substitute(value, literals) for value in label)
+    if isinstance(label, str):
+        return literals.get(label, label)
+    return label
+
+
+class CanonicalCache:
+    """
+    canonical SQL queries and spider labels of query skeletons, in an LRU cache
+
+    Generated queries of a template share their skeleton, the query with the literals masked, so canonicalisation and
+    parsing run once per skeleton and the literals are put back into the results.
+
+    Attributes:
+        int capacity: maximum number of skeletons, 0 to disable the cache
+        OrderedDict entries: canonical skeleton and label by skeleton, least recently used first
+        int hits: number of queries answered from the cache
+        int misses: number of queries canonicalised and parsed
+        int bypassed: number of queries with literals that cannot be masked
+        float compute_time: seconds spent canonicalising and parsing skeletons
+    """
+
+    def __init__(self, capacity=10000):
+        """
+        :param int capacity: maximum number of skeletons, 0 to disable the cache
+        """
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.compute_time = 0.0
+
+    def label(self, sql, key, canonicalise, parse):
+        """
+        canonical form and spider label of a query
+
+        :param str sql: SQL query with tokens separated by blank spaces
+        :param tuple key: everything besides the skeleton the results depend on, e.g. the variable names
+        :param function canonicalise: maps a query to its canonical form
+        :param function parse: maps a canonical query to its label, raises AssertionError if it cannot be parsed
+        :return tuple: canonical query and label, the label is None if the query cannot be parsed
+        """
+        masked = skeleton(sql) if self.capacity else None
+        if masked is None:
+            self.bypassed += 1
+            return self.compute(sql, canonicalise, parse)
+
+        sql_skeleton, literals = masked
+        entry_key = (sql_skeleton,) + key
+        entry = self.entries.get(entry_key)
+        if entry is None:
+            start = time.perf_counter()
+            entry = self.compute(sql_skeleton, canonicalise, parse)
+            self.compute_time += time.perf_counter() - start
+            self.misses += 1
+            self.entries[entry_key] = entry
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+        else:
+            self.hits += 1
+            self.entries.move_to_end(entry_key)
+
+        canonical, label = entry
+        if literals:
+            canonical = ' '.join(literals.get(token, token) for token in canonical.split(' '))
+        return canonical, substitute(label, literals) if label is not None else None
+
+    @staticmethod
+    def compute(sql, canonicalise, parse):
+        """
+        :param str sql: SQL query
+        :param function canonicalise: maps a query to its canonical form
+        :param function parse: maps a canonical query to its label
+        :return tuple: canonical query and label, None if the query cannot be parsed
+        """
+        canonical = canonicalise(sql)
+        try:
+            return canonical, parse(canonical)
+        except AssertionError:
+            return canonical, None
+
+    def statistics(self):
+        """
+        :return str: hit rate and estimated time saved
+        """
+        lookups = self.hits + self.misses + self.bypassed
+        hit_rate = self.hits / lookups if lookups else 0.0
+        saved = self.hits * self.compute_time / self.misses if self.misses else 0.0
+        return (f'canonical cache hit rate {hit_rate:.1%}: {self.hits} hits, {self.misses} misses, '
+                f'{self.bypassed} bypassed, about {saved:.1f}s saved')
@@ -10,6 +10,7 @@ provided parentheses are respected).
 
 import re
 import string
+from bisect import bisect_left
 
 LOGGING = False
 #  Alterations:
@@ -19,6 +20,7 @@ LOGGING = False
 #
 #  2. standardise_blank_spaces(query):
 #  Ensures there is one blank space between each special character and word.
+#  A single pass lexer (canonical_tokens) splits the query into these tokens.
 #
 #  3. capitalise(query, variables):
 #  Converts all non-quoted sections of the query to uppercase.
@@ -141,11 +143,13 @@ def update_quotes(char, in_single, in_double):
     return in_single, in_double
 
 
-def standardise_blank_spaces(query):
+def standardise_blank_spaces_reference(query):
     """
+    original character by character implementation of standardise_blank_spaces, used for queries with nested or
+    unterminated quotes and to verify the lexer
 
-    :param query:
-    :return:
+    :param str query: SQL query
+    :return str: query with standardised blank spaces
     """
     # split on special characters except _.:-
     in_squote, in_dquote = False, False
@@ -253,19 +257,94 @@ def standardise_blank_spaces(query):
     return new_query
 
 
-def capitalise(query, variables):
+# outside of quotes, runs of comparison and arithmetic operators form one token, the other special characters
+# are tokens of their own; quoted strings are matched as a whole, stray quotes are unterminated
+RE_LEXER = re.compile(r'''"[^"]*"|'[^']*'|[!=<>+*]+|[,;()\[\]{}/\\#]|[^\s!=<>,;()\[\]{}+*/\\#"']+|["']''')
+
+# spaces between these functions and their parenthesis would break SQL
+RE_FUNCTION_SPACE = re.compile(r'(count|lower|max|min|sum|COUNT|LOWER|MAX|MIN|SUM) \(')
+
+# tokens kept as they are by capitalise
+UNCAPITALISED = {"credit0", "level0", "level1", "number0", "number1", "year0", "business_rating0", 'value'}
+
+
+def trim_quoted(content):
     """
+    remove blank spaces just inside quotes, and next to a % just inside quotes
 
-    :param query:
-    :param variables:
-    :return:
+    :param str content: text between two quotes
+    :return str: trimmed text
+    """
+    content = content.lstrip(' \n')
+    if content[:1] == '%':
+        content = '%' + content[1:].lstrip(' \n')
+    if content and content[-1] in ' \n':
+        content = content[:-1]
+    elif len(content) > 1 and content[-1] == '%' and content[-2] in ' \n':
+        content = content[:-2] + '%'
+    return content
+
+
+def canonical_tokens(query):
+    """
+    split a query into canonical tokens in a single pass: special characters are separated by blank spaces, blank
+    spaces just inside quotes are removed and single quotes are replaced with double quotes where possible
+
+    ' '.join of the tokens equals standardise_blank_spaces_reference, queries with quotes inside double quotes or
+    unterminated quotes are handed to it
+
+    :param str query: SQL query
+    :return list: tokens
+    """
+    tokens = []
+    for match in RE_LEXER.finditer(query):
+        token = match.group()
+        quote = token[0]
+        if quote == '"' or quote == "'":
+            if len(token) == 1 or quote == '"' and "'" in token:
+                return standardise_blank_spaces_reference(query).split()
+            content = trim_quoted(token[1:-1])
+            if quote == "'" and '"' not in content:
+                quote = '"'
+            tokens.extend((quote + content + quote).split())
+        else:
+            tokens.append(token)
+
+    if '(' in query:
+        new_query = ' '.join(tokens)
+        new_query = RE_FUNCTION_SPACE.sub(lambda function: function.group(1).upper() + '(', new_query)
+        new_query = new_query.replace('COUNT(*', 'COUNT( *')
+        new_query = new_query.replace('YEAR ( CURDATE ( ) )', 'YEAR(CURDATE())')
+        tokens = new_query.split()
+
+    return tokens
+
+
+def standardise_blank_spaces(query):
+    """
+    ensure there is one blank space between each special character and word
+
+    :param str query: SQL query
+    :return str: query with standardised blank spaces
+    """
+    return ' '.join(canonical_tokens(query))
+
+
+def capitalise_tokens(tokens, variables):
+    """
+    convert all non-quoted sections of the tokens to uppercase, except variables
+
+    :param list tokens: canonical tokens
+    :param variables: variable names
+    :return list: capitalised tokens
     """
     ntokens = []
     in_squote, in_dquote = False, False
-    for token in query.split():
-        if token in variables or token in ["credit0", "level0", "level1", "number0", "number1", "year0",
-                                           "business_rating0", 'value']:
+    for token in tokens:
+        if token in variables or token in UNCAPITALISED:
             ntokens.append(token)
+        elif '"' not in token and "'" not in token:
+            ntokens.append(token if in_squote or in_dquote else token.upper())
         else:
             modified = []
             for char in token:
@@ -279,7 +358,18 @@ def capitalise(query, variables):
                 in_squote, in_dquote = update_quotes(char, in_squote, in_dquote)
             ntokens.append(''.join(modified))
 
-    return ' '.join(ntokens)
+    return ntokens
+
+
+def capitalise(query, variables):
+    """
+    convert all non-quoted sections of the query to uppercase, except variables
+
+    :param str query: SQL query with standardised blank spaces
+    :param variables: variable names
+    :return str: capitalised query
+    """
+    return ' '.join(capitalise_tokens(query.split(), variables))
 
 
 def subquery_range(current, pos, tokens, in_quote=False):
@@ -332,9 +422,137 @@ def subquery_range(current, pos, tokens, in_quote=False):
         return current
 
 
+class SubqueryIndex:
+    """
+    parenthesis structure of a token list, built once per query, answering subquery_range in constant time
+
+    The scans of subquery_range start with a fresh quote state, so a token counts as a parenthesis if the double
+    quotes between the start of the scan and the token are balanced. Forward and backward scans therefore see one of
+    two views of the tokens, selected by the quote parity at the start, and the matching parenthesis of every start
+    position is precomputed for its view. With single quotes the quote state is no parity, then the tokens are
+    scanned as before.
+
+    Attributes:
+        list tokens: tokens of the query, tokens are inserted through insert
+        bool exact: whether the precomputed ranges are used, False for tokens with single quotes
+        list origin: original index of each token, inserted tokens have the one of the token before them
+        list anchors: original index before each inserted token, in order of insertion
+        list forward_end: per original token, end of the subquery range of a forward scan after it
+        list backward_open: per original token, position of the opening parenthesis found by a backward scan from it
+        list next_close: per original token, position of the next ')' token
+    """
+
+    def __init__(self, tokens, exact=True):
+        """
+        :param list tokens: tokens of the query, shared with the caller
+        :param bool exact: False to always scan the tokens
+        """
+        self.tokens = tokens
+        self.exact = exact and not any("'" in token for token in tokens)
+        self.origin = list(range(len(tokens)))
+        self.anchors = []
+        if not self.exact:
+            return
+
+        self.forward_end = [None] * len(tokens)
+        self.backward_open = [None] * len(tokens)
+        self.next_close = [None] * len(tokens)
+
+        # per view: parenthesis depth, forward scan starts waiting for the depth to drop below their level,
+        # and the last position at each depth for backward scans
+        forward_depth, waiting = [0, 0], [{}, {}]
+        backward_depth, last_at_depth = [0, 0], [{}, {}]
+        parity = 0
+        for i, token in enumerate(tokens):
+            previous_parity = parity
+            if '"' in token:
+                parity ^= token.count('"') & 1
+
+            delta = 1 if '(' in token else -1 if ')' in token else 0
+            if delta:
+                # a forward scan evaluates the token after, a backward scan before reading its quotes
+                forward_depth[parity] += delta
+                if delta < 0:
+                    for start in waiting[parity].pop(forward_depth[parity] + 1, ()):
+                        self.forward_end[start] = i + 1
+                backward_depth[previous_parity] += delta
+            waiting[parity].setdefault(forward_depth[parity], []).append(i)
+
+            before = last_at_depth[parity].get(backward_depth[parity] - 1)
+            if before is not None:
+                self.backward_open[i] = before + 1
+            last_at_depth[0][backward_depth[0]] = i
+            last_at_depth[1][backward_depth[1]] = i
+
+        next_close = None
+        for i in range(len(tokens) - 1, -1, -1):
+            self.next_close[i] = next_close
+            if tokens[i] == ')':
+                next_close = i
+
+    def insert(self, pos, token):
+        """
+        insert a token without parentheses and quotes
+
+        :param int pos: position
+        :param str token: token
+        """
+        self.tokens.insert(pos, token)
+        anchor = self.origin[pos - 1]
+        self.origin.insert(pos, anchor)
+        self.anchors.append(anchor)
+
+    def position(self, original):
+        """
+        :param int original: original index of a token
+        :return int: current position of the token
+        """
+        return original + bisect_left(self.anchors, original)
+
+    def subquery_range(self, current, pos, in_quote=False):
+        """
+        same as subquery_range on the tokens
+
+        :param tuple current: current subquery range or None
+        :param int pos: position
+        :param bool in_quote: whether the position is quoted
+        :return tuple: subquery range
+        """
+        if not self.exact:
+            return subquery_range(current, pos, self.tokens, in_quote)
+
+        original = self.origin[pos]
+        if self.tokens[pos] == '(' and not in_quote:
+            end = self.forward_end[original]
+            if end is None:
+                raise IndexError(f'unbalanced parenthesis at {pos} in {" ".join(self.tokens)}')
+            return pos, end + pos - original
+        elif current is not None and pos == current[1]:
+            start = 0
+            if self.backward_open[original] is not None:
+                start = self.position(self.backward_open[original])
+                if start == 1:
+                    start = 0
+
+            end = len(self.tokens)
+            if self.next_close[original] is not None:
+                end = self.position(self.next_close[original]) + 1
+            return start, end
+        else:
+            return current
+
+
 ALIAS_PATTERN = re.compile("[A-Za-z0-9_]*")
 
 
+def has_structure(token):
+    """
+    :param str token: token
+    :return bool: whether the token contains quotes or parentheses
+    """
+    return '"' in token or "'" in token or '(' in token or ')' in token
+
+
 def standardise_aliases(query, schema):
     """
 
@@ -346,6 +564,7 @@ def standardise_aliases(query, schema):
     aliases = {}  # dictionary mapping old aliases to standardised aliases
     field_aliases = {}
     tokens = query.split()
+    index = SubqueryIndex(tokens)
 
     # insert AS and replace old alias name with new alias name
     current_subquery = (0, -1)
@@ -356,7 +575,7 @@ def standardise_aliases(query, schema):
         for part in word.split('"'):
             in_quote = not in_quote
         in_quote = not in_quote
-        current_subquery = subquery_range(current_subquery, i, tokens, in_quote)
+        current_subquery = index.subquery_range(current_subquery, i, in_quote)
         if word == "FROM":
             if LOGGING: print("Seen from", current_subquery[0], i)
             seen_from[current_subquery[0]] = i
@@ -371,7 +590,7 @@ def standardise_aliases(query, schema):
         if word in schema[0] and not seen_where[current_subquery[0]] and seen_from[current_subquery[0]]:
             count[word] = count.get(word, -1) + 1
             if len(tokens) < i + 2 or tokens[i + 1] != 'AS':
-                tokens.insert(i + 1, 'AS')
+                index.insert(i + 1, 'AS')
             alias = word + "alias" + str(count[word])
 
             # Check if there is an alias there now
@@ -387,7 +606,7 @@ def standardise_aliases(query, schema):
                 tokens[i + 2] = alias
             else:
                 aliases[current_subquery[0], word] = alias
-                tokens.insert(i + 2, alias)
+                index.insert(i + 2, alias)
         elif i > 2 and tokens[i - 1] == 'AS':
             if tokens[i - 2] not in schema[0]:
                 if LOGGING: print("Considering", tokens[i - 2:i + 1], current_subquery, seen_from[current_subquery[0]])
@@ -402,6 +621,8 @@ def standardise_aliases(query, schema):
                 else:
                     # print("New alias", current_subquery[0], tokens[i], alias)
                     aliases[current_subquery[0], tokens[i]] = alias
+                if has_structure(tokens[i]):
+                    index.exact = False
                 tokens[i] = alias
 
     # replace old alias names for the columns with new alias names
@@ -411,12 +632,22 @@ def standardise_aliases(query, schema):
             print(alias, aliases[alias])
         for field_alias in field_aliases:
             print(field_alias, field_aliases[field_alias])
+
+    # old aliases are replaced by tokens without quotes and parentheses, which keeps the index valid
+    index = SubqueryIndex(tokens, not any(has_structure(old) for old in field_aliases) and
+                          not any(has_structure(old) for _, old in aliases))
+    # aliases by old name and the first alias of each table per subquery
+    named_aliases = None
+    table_aliases = {}
+    for pair, alias in aliases.items():
+        table_aliases.setdefault((pair[0], alias.split("alias")[0]), alias)
+
     in_quote = False
     for i, word in enumerate(tokens):
         for part in word.split('"'):
             in_quote = not in_quote
         in_quote = not in_quote
-        current_subquery = subquery_range(current_subquery, i, tokens, in_quote)
+        current_subquery = index.subquery_range(current_subquery, i, in_quote)
         if (current_subquery[0], word) in aliases:
             if len(tokens) > i + 1 and tokens[i + 1] != "AS":
                 tokens[i] = aliases[current_subquery[0], word]
@@ -432,8 +663,12 @@ def standardise_aliases(query, schema):
                     field = field_aliases[parts[1]]
                 tokens[i] = table + "." + field
             else:
-                for alias in aliases:
-                    other = subquery_range((0, -1), alias[0], tokens)
+                # without the index, tokens with parentheses may have been replaced since the last time
+                if named_aliases is None or not index.exact:
+                    named_aliases = {}
+                    for alias in aliases:
+                        named_aliases.setdefault(alias[1], []).append((alias, index.subquery_range((0, -1), alias[0])))
+                for alias, other in named_aliases.get(parts[0], ()):
                     if LOGGING: print("   ", alias, alias[1], parts[0], other[0], current_subquery[0], other[1], i)
                     if alias[1] == parts[0] and other[0] < current_subquery[0] and (other[1] == -1 or other[1] > i):
                         tokens[i] = aliases[alias] + '.' + parts[1]
@@ -447,23 +682,22 @@ def standardise_aliases(query, schema):
             if sf is None or i < sf or (sw is not None and i > sw):
                 for table in schema[0]:
                     # print(table, schema[0][table])
-                    if word in schema[0][table]:
+                    if word in schema[0][table] and (current_subquery[0], table) in table_aliases:
                         # print("Found", i, word, table, current_subquery)
-                        for pair in aliases:
-                            alias = aliases[pair]
-                            start = alias.split("alias")[0]
-                            if pair[0] == current_subquery[0] and start == table:
-                                tokens[i] = alias + '.' + word
-                                done = True
-                                break
-                        if done:
-                            break
+                        tokens[i] = table_aliases[current_subquery[0], table] + '.' + word
+                        done = True
+                        break
             if (not done) and word in field_aliases:
                 tokens[i] = field_aliases[word]
 
     return ' '.join(tokens)
 
 
+# keywords ending the FROM and the WHERE clause
+FROM_END = {"WHERE", "JOIN", "GROUP", "HAVING", "LIMIT", "ORDER", ";"}
+WHERE_END = {"GROUP", "HAVING", "LIMIT", "ORDER", ";"}
+
+
 def tokens_for_chunk(tokens, chunk):
     """
 
@@ -480,16 +714,17 @@ def get_matching_chunk(tokens, chunks, pos, target, default=None):
     :param tokens:
     :param chunks:
     :param pos:
-    :param target:
+    :param target: keyword or set of keywords, e.g. those ending a clause
     :param default:
     :return:
     """
+    targets = {target} if isinstance(target, str) else target
     saw_between = False
     while pos < len(chunks):
         chunk = chunks[pos]
         if tokens[chunk[0]].upper() == "BETWEEN":
             saw_between = True
-        if chunk[0] == chunk[1] and tokens[chunk[0]] == target:
+        if chunk[0] == chunk[1] and tokens[chunk[0]] in targets:
             if target != "AND" or (not saw_between):
                 return pos
         if saw_between and tokens[chunk[0]].upper() == 'AND':
@@ -528,6 +763,17 @@ def sort_chunk_list(start, end, chunks, tokens, separator=","):
         for info in to_rearrange:
             saw_between = False
             for i in range(info[1], info[2] + 1):
+                # subqueries are copied as a whole
+                if chunks[i][1] - chunks[i][0] > 1 and cpos + chunks[i][1] - chunks[i][0] < len(tokens):
+                    block = ctokens[chunks[i][0] - min_pos:chunks[i][1] - min_pos + 1]
+                    tokens[cpos:cpos + len(block)] = block
+                    cpos += len(block)
+                    if 'BETWEEN' in block:
+                        saw_between = 'AND' not in block[len(block) - block[::-1].index('BETWEEN'):]
+                    elif 'AND' in block:
+                        saw_between = False
+                    continue
+
                 for j in range(chunks[i][0], chunks[i][1] + 1):
                     token = ctokens[j - min_pos]
                     advance = False
@@ -547,15 +793,19 @@ def sort_chunk_list(start, end, chunks, tokens, separator=","):
             cpos += 1
 
 
-def order_sequence(tokens, start, end, variables):
+def order_sequence(tokens, start, end, variables, index=None):
     """
 
     :param tokens:
     :param start:
     :param end:
     :param variables:
+    :param SubqueryIndex index: subquery ranges of the tokens, built if None
     :return:
     """
+    if index is None:
+        index = SubqueryIndex(tokens)
+
     # Note - using https://ronsavage.github.io/SQL/sql-92.bnf.html to assist in
     # this construction.
 
@@ -567,13 +817,14 @@ def order_sequence(tokens, start, end, variables):
         for part in tokens[cpos].split('"'):
             in_quote = not in_quote
         in_quote = not in_quote
-        sub = subquery_range(None, cpos, tokens, in_quote)
+        # subqueries only rearrange their own tokens, so the index of the unordered tokens stays valid
+        sub = index.subquery_range(None, cpos, in_quote)
         if sub is None:
             chunks.append((cpos, cpos))
             cpos += 1
         else:
             chunks.append((cpos, sub[1] - 1))
-            order_sequence(tokens, sub[0], sub[1] - 1, variables)
+            order_sequence(tokens, sub[0], sub[1] - 1, variables, index)
             cpos = sub[1]
 
     # Handle SELECT
@@ -582,10 +833,10 @@ def order_sequence(tokens, start, end, variables):
         next_select = get_matching_chunk(tokens, chunks, cur_chunk, "SELECT")
         if next_select is None: break
 
-        next_distinct = get_matching_chunk(tokens, chunks, next_select, "DISTINCT")
-        next_all = get_matching_chunk(tokens, chunks, next_select, "ALL")
-        if next_distinct == next_select + 1 or next_all == next_select + 1:
-            next_select += 1
+        if next_select + 1 < len(chunks):
+            quantifier = chunks[next_select + 1]
+            if quantifier[0] == quantifier[1] and tokens[quantifier[0]] in ("DISTINCT", "ALL"):
+                next_select += 1
 
         next_from = get_matching_chunk(tokens, chunks, next_select, "FROM", len(chunks))
 
@@ -636,15 +887,7 @@ def order_sequence(tokens, start, end, variables):
         next_from = get_matching_chunk(tokens, chunks, cur_chunk, "FROM")
         if next_from is None: break
 
-        next_item = min(
-            get_matching_chunk(tokens, chunks, next_from, "WHERE", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "JOIN", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "GROUP", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "HAVING", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "LIMIT", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, "ORDER", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_from, ";", len(chunks))
-        )
+        next_item = get_matching_chunk(tokens, chunks, next_from, FROM_END, len(chunks))
         sort_chunk_list(next_from + 1, next_item, chunks, tokens)
         cur_chunk = next_item
 
@@ -658,13 +901,7 @@ def order_sequence(tokens, start, end, variables):
             else:
                 break
 
-        next_item = min(
-            get_matching_chunk(tokens, chunks, next_where, "GROUP", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, "HAVING", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, "LIMIT", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, "ORDER", len(chunks)),
-            get_matching_chunk(tokens, chunks, next_where, ";", len(chunks))
-        )
+        next_item = get_matching_chunk(tokens, chunks, next_where, WHERE_END, len(chunks))
         has_and = False
         has_or = False
         saw_between = False
@@ -697,7 +934,7 @@ def order_query(query, variables):
     :return:
     """
     tokens = query.split()
-    order_sequence(tokens, 0, len(tokens) - 1, variables)
+    order_sequence(tokens, 0, len(tokens) - 1, variables, SubqueryIndex(tokens))
     return ' '.join(tokens)
 
 
@@ -712,9 +949,11 @@ def make_canonical(query, schema, variables, skip=set()):
     """
     if 'add_semicolon' not in skip:
         query = add_semicolon(query)
-    if 'standardise_blank_spaces' not in skip:
+    if 'standardise_blank_spaces' not in skip and 'capitalise' not in skip:
+        query = ' '.join(capitalise_tokens(canonical_tokens(query), variables))
+    elif 'standardise_blank_spaces' not in skip:
         query = standardise_blank_spaces(query)
-    if 'capitalise' not in skip:
+    elif 'capitalise' not in skip:
         query = capitalise(query, variables)
     if 'standardise_aliases' not in skip:
         query = standardise_aliases(query, schema)
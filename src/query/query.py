@@ -7,29 +7,52 @@ import logging
 import random
 import re
 from copy import deepcopy, copy
-from itertools import product
+from itertools import product, islice
 from math import ceil
 
-from nltk import word_tokenize
-
 from db.sqlite_utils import create_connection
 from query.canonicaliser import make_canonical
-from query.query_utils import tokenize_sql, translate_argmax_min, groupable, tokenize_nl, \
+from query.query_utils import tokenize_sql, groupable, tokenize_nl, \
     list_replace, compSuperDict, join_col, create_join_string, funcParticipleDict, argCommandDict, compDict, funcDict, \
     funcCommandDict, SEP, MAIN_ENT
+from query.sample_store import SqlRecord
+from query.sql_tree import parse, transform, render, join_args, drop_empty
 
 RE_ENT_LETTER = re.compile(re.compile(r'{ENT[a-z]\}'))
 RE_ENT_NUMBER = re.compile(r'{ENT[^0-9]\}')
 RE_TEMPLATE = re.compile(r'{.*?\}')
 RE_NUMERICAL = re.compile(r'\s(<|>|>=|<=)\s+(?!INTEGER|NUMBER|{)\S')
+# quoted placeholders and tens, replaced by value in one scan
+RE_NO_VALUE = re.compile(r'"value"|10')
 
-class Query:
+class QueryContext:
     """
-    representing a NL/SQL query
+    context shared by all queries of a generation run, never modified by a query
 
     Attributes:
         Namespace parameters: parameters from generation call
         Schema schema: DB schema
+    """
+
+    __slots__ = ('parameters', 'schema')
+
+    def __init__(self, schema, parameters):
+        """
+        :param Schema schema: schema of the DB
+        :param Namespace parameters: parameters of the generation call
+        """
+        self.schema = schema
+        self.parameters = parameters
+
+
+class Query:
+    """
+    representing a NL/SQL query
+
+    Queries are copied for every filled slot, so they only hold their own state in slots and share a QueryContext.
+
+    Attributes:
+        QueryContext context: parameters and schema shared by all queries of a run
         float layer: filtering parameter
         list nl_tokens: tokenized nl query
         list sql_tokens: tokenized sql query
@@ -40,18 +63,19 @@ class Query:
         dict variables: mapping from placeholders to possible literals
     """
 
-    def __init__(self, nl, sql, schema, parameters, layer=1.0):
+    __slots__ = ('context', 'layer', 'nl_tokens', 'sql_tokens', 'groupable', 'ent', 'nl_tokens_filled',
+                 'sql_tokens_filled', 'variables')
+
+    def __init__(self, nl, sql, context, layer=1.0):
         """
         create a query object containing nl and sql
 
         :param str nl: NL query
         :param str sql: SQL query
-        :param Schema schema: schema of the corresponding DB
-        :param Namespace parameters: parameters of the original generation call
+        :param QueryContext context: schema of the corresponding DB and parameters of the original generation call
         :param float layer: parameter for filtering
         """
-        self.parameters = parameters
-        self.schema = schema
+        self.context = context
         self.layer = layer
 
         self.nl_tokens = tokenize_nl(nl)
@@ -63,6 +87,20 @@ class Query:
         self.sql_tokens_filled = None
         self.variables = {}
 
+    @property
+    def parameters(self):
+        """
+        :return Namespace: parameters of the generation call
+        """
+        return self.context.parameters
+
+    @property
+    def schema(self):
+        """
+        :return Schema: DB schema
+        """
+        return self.context.schema
+
     def get_sql(self, filled=False):
         """
         reconstruct SQL query by joining tokens with spaces
@@ -99,62 +137,145 @@ class Query:
         representing tables in the DB linked through a foreign key.
         Leaves ENT 1,2,3 etc. intact.
         Modifies 'self' but does not add it to output!
+        The new queries are created lazily from a copy of the unmodified query.
 
-        :return list: a list of queries with JOIN placeholders and ENT$letter replaced
+        :return generator: queries with JOIN placeholders and ENT$letter replaced
         """
 
-        new_queries = []
-
         # find all ent slots with a letter
         ent_slots = list({w for w in re.findall(RE_ENT_LETTER, self.get_nl() + " " + self.get_sql())})
         ent_slots.sort()
 
-        main_ent_token = MAIN_ENT + '.{FROM}' if any(('{FROM}' in token for token in self.sql_tokens)) else MAIN_ENT
-
         # create new queries with join templates, unless requested otherwise in parameters or not enough slots/tables
         if not self.parameters.no_join and len(ent_slots) > 0 and len(self.schema.tables) > 1:
+            new_queries = deepcopy(self).iter_join_variants(ent_slots)
+        else:
+            new_queries = iter(())
+
+        # modify the original query to no longer include other ENT slots than the main ENT
+        for ent_slot in ent_slots:
+            list_replace(self.nl_tokens, ent_slot, MAIN_ENT, MAIN_ENT)
+            list_replace(self.sql_tokens, ent_slot, MAIN_ENT, MAIN_ENT)
 
-            # all possible combinations of 1 and 2, repetitions based on amount of ENT slots
-            cross_products = [i for i in product([1, 2], repeat=len(ent_slots))]
+        return new_queries
 
-            join_from = f'JOIN_FROM( {MAIN_ENT} {SEP} {{ENT2}} )'
-            join_where = f'JOIN_WHERE( {MAIN_ENT} {SEP} {{ENT2}} ) AND'
-            where_join_where = f'WHERE JOIN_WHERE( {MAIN_ENT} {SEP} {{ENT2}} )'
+    def iter_join_variants(self, ent_slots):
+        """
+        create a query with join templates for every combination of ENT1 and ENT2 in the ENT slots
 
-            # skip all ENT1 (trivial case after loop), skip all ENT2 to avoid joins over tables not being used otherwise
-            for cross_product in cross_products[1:-1]:
-                new_query = deepcopy(self)
+        :param list ent_slots: sorted ENT slots with a letter
+        :return generator: queries with JOIN placeholders and ENT$letter replaced
+        """
 
-                for i, ent_slot in enumerate(ent_slots):
-                    slot_fill_ent = f'{{ENT{cross_product[i]}}}'
-                    list_replace(new_query.nl_tokens, ent_slot, slot_fill_ent, slot_fill_ent)
-                    list_replace(new_query.sql_tokens, ent_slot, slot_fill_ent, slot_fill_ent)
-                list_replace(new_query.nl_tokens, main_ent_token, MAIN_ENT, MAIN_ENT)
+        main_ent_token = MAIN_ENT + '.{FROM}' if any(('{FROM}' in token for token in self.sql_tokens)) else MAIN_ENT
 
-                list_replace(new_query.sql_tokens, main_ent_token, main_ent_token, join_from)
+        join_from = f'JOIN_FROM( {MAIN_ENT} {SEP} {{ENT2}} )'
+        join_where = f'JOIN_WHERE( {MAIN_ENT} {SEP} {{ENT2}} ) AND'
+        where_join_where = f'WHERE JOIN_WHERE( {MAIN_ENT} {SEP} {{ENT2}} )'
+        # the join templates are inserted as tokens
+        join_tokens = {join: tokenize_sql(join) for join in [join_from, join_where, where_join_where]}
 
-                from_index = new_query.sql_tokens.index('FROM')
-                if 'WHERE' in new_query.sql_tokens:  # insert after 'WHERE'
-                    new_query.sql_tokens[from_index + 3:from_index + 3] = [join_where]
-                else:  # insert after JOIN_FROM
-                    new_query.sql_tokens[from_index + 2:from_index + 2] = [where_join_where]
+        # all possible combinations of 1 and 2, repetitions based on amount of ENT slots
+        # skip all ENT1 (trivial case in the original query), skip all ENT2 to avoid joins over tables not being used
+        # otherwise
+        cross_products = islice(product([1, 2], repeat=len(ent_slots)), 1, 2 ** len(ent_slots) - 1)
+        if self.parameters.max_join_variants:
+            cross_products = self.sample_join_variants(ent_slots)
 
-                new_query.sql_tokens = tokenize_sql(new_query.get_sql())
+        for cross_product in cross_products:
+            new_query = deepcopy(self)
 
-                # artificially boost recursive layer of new templates
-                new_query.layer += self.parameters.join_boost + len(ent_slots)
+            for i, ent_slot in enumerate(ent_slots):
+                slot_fill_ent = f'{{ENT{cross_product[i]}}}'
+                list_replace(new_query.nl_tokens, ent_slot, slot_fill_ent, slot_fill_ent)
+                list_replace(new_query.sql_tokens, ent_slot, slot_fill_ent, slot_fill_ent)
+            list_replace(new_query.nl_tokens, main_ent_token, MAIN_ENT, MAIN_ENT)
 
-                assert not re.search(RE_ENT_NUMBER, new_query.get_nl()), f'bad ENT slot in NL:{new_query.get_nl()}'
-                assert not re.search(RE_ENT_NUMBER, new_query.get_sql()), f'bad ENT slot in SQL:{new_query.get_sql()}'
+            list_replace(new_query.sql_tokens, main_ent_token, main_ent_token, join_from)
 
-                new_queries.append(new_query)
+            from_index = new_query.sql_tokens.index('FROM')
+            if 'WHERE' in new_query.sql_tokens:  # insert after 'WHERE'
+                new_query.sql_tokens[from_index + 3:from_index + 3] = [join_where]
+            else:  # insert after JOIN_FROM
+                new_query.sql_tokens[from_index + 2:from_index + 2] = [where_join_where]
 
-        # modify the original query to no longer include other ENT slots than the main ENT
-        for ent_slot in ent_slots:
-            list_replace(self.nl_tokens, ent_slot, MAIN_ENT, MAIN_ENT)
-            list_replace(self.sql_tokens, ent_slot, MAIN_ENT, MAIN_ENT)
+            new_query.sql_tokens = [new_token for token in new_query.sql_tokens
+                                    for new_token in join_tokens.get(token, [token])]
 
-        return new_queries
+            # artificially boost recursive layer of new templates
+            new_query.layer += self.parameters.join_boost + len(ent_slots)
+
+            assert not re.search(RE_ENT_NUMBER, new_query.get_nl()), f'bad ENT slot in NL:{new_query.get_nl()}'
+            assert not re.search(RE_ENT_NUMBER, new_query.get_sql()), f'bad ENT slot in SQL:{new_query.get_sql()}'
+
+            yield new_query
+
+    def sample_join_variants(self, ent_slots):
+        """
+        sample at most max_join_variants combinations of ENT1 and ENT2, weighted by the number of pairs of tables
+        that can fill them: tables linked by foreign keys, with a number column for each slot that requires one
+
+        The weight only depends on whether ENT1 and ENT2 fill a number slot, so the combinations fall into classes of
+        equal weight. A class is drawn proportionally to its weight times its unsampled combinations, then one of them
+        uniformly, without enumerating all combinations.
+
+        :param list ent_slots: sorted ENT slots with a letter
+        :return list: sampled combinations of 1 and 2 for the ENT slots in the order of itertools.product
+        """
+
+        sql = self.get_sql()
+        numerical_slots = [i for i, ent_slot in enumerate(ent_slots)
+                           if re.search(re.escape(ent_slot) + r'\.\{COL[^}]*f\}', sql)]
+        free_slots = [i for i in range(len(ent_slots)) if i not in numerical_slots]
+        numerical_tables = {ent for ent, columns in self.schema.tables.items()
+                            if any(column['type'] in ['INTEGER', 'NUMBER'] for column in columns.values())}
+
+        # weight by whether ENT1 and ENT2 need a number column
+        weights = {(need1, need2): 0 for need1 in [False, True] for need2 in [False, True]}
+        for table1, table2 in self.schema.join_paths:
+            for need1, need2 in weights:
+                if (not need1 or table1 in numerical_tables) and (not need2 or table2 in numerical_tables):
+                    weights[need1, need2] += 1
+
+        # classes as weight and ranges of bit patterns (0 for ENT1, 1 for ENT2) of the number and the other slots,
+        # excluding the combinations of only ENT1 or only ENT2
+        full_free = 2 ** len(free_slots)
+        if numerical_slots:
+            full_numerical = 2 ** len(numerical_slots)
+            classes = [(weights[True, False], (0, 1), (1, full_free)),
+                       (weights[False, True], (full_numerical - 1, full_numerical), (0, full_free - 1)),
+                       (weights[True, True], (1, full_numerical - 1), (0, full_free))]
+        else:
+            classes = [(weights[False, False], (0, 1), (1, full_free - 1))]
+        sizes = [(numerical[1] - numerical[0]) * (free[1] - free[0]) for _, numerical, free in classes]
+
+        chosen = set()
+        remaining = list(sizes)
+        while len(chosen) < self.parameters.max_join_variants:
+            totals = [weight * count for (weight, _, _), count in zip(classes, remaining)]
+            if not any(totals):
+                break
+
+            # weighted sampling without replacement, one draw at a time
+            c = random.choices(range(len(classes)), weights=totals)[0]
+            index = random.randrange(sizes[c])
+            while (c, index) in chosen:
+                index = random.randrange(sizes[c])
+            chosen.add((c, index))
+            remaining[c] -= 1
+
+        cross_products = []
+        for c, index in chosen:
+            _, numerical, free = classes[c]
+            patterns = [(numerical[0] + index // (free[1] - free[0]), numerical_slots),
+                        (free[0] + index % (free[1] - free[0]), free_slots)]
+            cross_product = [0] * len(ent_slots)
+            for pattern, slots in patterns:
+                for j, slot in enumerate(slots):
+                    cross_product[slot] = 1 + (pattern >> (len(slots) - 1 - j) & 1)
+            cross_products.append(tuple(cross_product))
+
+        return sorted(cross_products)
 
     def create_argmin_max(self):
         """
@@ -201,7 +322,7 @@ class Query:
         apply slot-filling dictionary or other slot filling mechanism to the first template slot in the given token
 
         :param str token: token from the NL query that contains an unfilled slot
-        :param dict slot_fill_dict: dictionary that maps slots to possible values for NL queries
+        :param SlotDictionary slot_fill_dict: dictionary that maps slots to possible values for NL queries
         :return list: generated queries
         """
 
@@ -220,10 +341,10 @@ class Query:
         if slot in slot_fill_dict:
 
             number_of_samples = int(ceil(len(slot_fill_dict[slot]) * filter_probability))
-            for i, value in enumerate(random.sample(slot_fill_dict[slot], number_of_samples)):
+            for i, (value, sql_value) in enumerate(random.sample(slot_fill_dict.fills[slot], number_of_samples)):
                 new_query = deepcopy(self) if i < (number_of_samples - 1) else self
                 list_replace(new_query.nl_tokens, slot, value, value)
-                list_replace(new_query.sql_tokens, slot, value.upper(), value.upper())
+                list_replace(new_query.sql_tokens, slot, sql_value, sql_value)
 
                 new_query.layer += 1
 
@@ -336,15 +457,14 @@ class Query:
             column = split_token[1]
 
             columns = list(self.schema.type_dict[self.schema.tables[ent][column]['type']])
-            for new_column, new_ent in random.sample(columns,
-                                                     min(int(ceil(self.parameters.in_boost * filter_probability)),
-                                                         len(columns))):
+            number_of_samples = min(int(ceil(self.parameters.in_boost * filter_probability)), len(columns))
+            for i, (new_column, new_ent) in enumerate(random.sample(columns, number_of_samples)):
 
                 # exclude original table column combination
                 if new_column == column and new_ent == ent:
                     continue
 
-                new_query = deepcopy(self)
+                new_query = deepcopy(self) if i < number_of_samples - 1 else self
 
                 # replace MATCHFILL token
                 list_replace(new_query.nl_tokens, f'{ent}.{column}.{{MATCHFILL{slot[-2]}}}', f'{new_ent}.{new_column}',
@@ -386,8 +506,9 @@ class Query:
                 new_queries.append(self)
             else:
                 operators = ['=', '!=', '<', '>', '<=', '>=']
-                for comparison in random.sample(operators, int(ceil(len(operators) * filter_probability))):
-                    new_query = deepcopy(self)
+                number_of_samples = int(ceil(len(operators) * filter_probability))
+                for i, comparison in enumerate(random.sample(operators, number_of_samples)):
+                    new_query = deepcopy(self) if i < number_of_samples - 1 else self
 
                     list_replace(new_query.nl_tokens, slot, compDict[comparison], compDict[comparison])
                     list_replace(new_query.sql_tokens, slot, comparison, comparison)
@@ -399,8 +520,9 @@ class Query:
         # for slots representing functions
         elif '{FUNC' in slot:
 
-            for function in random.sample(functions, int(ceil(len(functions) * filter_probability))):
-                new_query = deepcopy(self)
+            number_of_samples = int(ceil(len(functions) * filter_probability))
+            for i, function in enumerate(random.sample(functions, number_of_samples)):
+                new_query = deepcopy(self) if i < number_of_samples - 1 else self
 
                 list_replace(new_query.nl_tokens, slot, funcDict[function], funcDict[function])
                 list_replace(new_query.sql_tokens, slot, function, function)
@@ -412,8 +534,9 @@ class Query:
         # for slots representing function commands
         elif '{funcCommand' in slot:
 
-            for function in random.sample(functions, int(ceil(len(functions) * filter_probability))):
-                new_query = deepcopy(self)
+            number_of_samples = int(ceil(len(functions) * filter_probability))
+            for i, function in enumerate(random.sample(functions, number_of_samples)):
+                new_query = deepcopy(self) if i < number_of_samples - 1 else self
 
                 list_replace(new_query.nl_tokens, slot, funcCommandDict[function], funcCommandDict[function])
                 list_replace(new_query.sql_tokens, slot, function, function)
@@ -425,8 +548,9 @@ class Query:
         # for slots representing function participles
         elif '{funcParticiple' in slot:
 
-            for function in random.sample(functions, int(ceil(len(functions) * filter_probability))):
-                new_query = deepcopy(self)
+            number_of_samples = int(ceil(len(functions) * filter_probability))
+            for i, function in enumerate(random.sample(functions, number_of_samples)):
+                new_query = deepcopy(self) if i < number_of_samples - 1 else self
 
                 list_replace(new_query.nl_tokens, slot, funcParticipleDict[function], funcParticipleDict[function])
                 list_replace(new_query.sql_tokens, slot, function, function)
@@ -439,8 +563,9 @@ class Query:
         elif '{ARG' in slot:
 
             arg_functions = ['argmax', 'argmin']
-            for minmax in random.sample(arg_functions, int(ceil(len(arg_functions) * filter_probability))):
-                new_query = deepcopy(self)
+            number_of_samples = int(ceil(len(arg_functions) * filter_probability))
+            for i, minmax in enumerate(random.sample(arg_functions, number_of_samples)):
+                new_query = deepcopy(self) if i < number_of_samples - 1 else self
 
                 list_replace(new_query.nl_tokens, slot, argCommandDict[minmax], argCommandDict[minmax])
                 list_replace(new_query.sql_tokens, slot, minmax, minmax)
@@ -480,8 +605,8 @@ class Query:
 
             words = ['and', 'or'] if random.random() < self.parameters.or_p else ['and']
 
-            for value in words:
-                new_query = deepcopy(self)
+            for i, value in enumerate(words):
+                new_query = deepcopy(self) if i < len(words) - 1 else self
 
                 list_replace(new_query.nl_tokens, slot, value, value)
                 list_replace(new_query.sql_tokens, slot, value.upper(), value.upper())
@@ -499,120 +624,74 @@ class Query:
 
         return new_queries
 
-    def translate_max_count(self):
+    def translate_max_count(self, items):
         """ translate COUNT_COND in SQL query to construct with JOIN, GROUP BY, ORDER BY
-        """
 
-        try:
-            i = self.sql_tokens.index('COUNT_COND')
-        except ValueError:
-            return True  # no COUNT_COND in the SQL query
-
-        table_1 = self.sql_tokens[i + 2]
-        table_2 = self.sql_tokens[i + 4]
-
-        if table_2 == table_1:
-            logging.warning('dropped query with aggregation over one table')
-            return False  # improper configuration of tables in COUNT_COND, ignore query
-
-        cond = []
-        cond_start = i + 6  # assuming minimal form COUNT_COND ( {ENT$} $ {ENT$} $ ) , point to closing parenthesis
-        idx_counter = 0
-        while self.sql_tokens[cond_start + idx_counter] != ")":
-            cond += [self.sql_tokens[cond_start + idx_counter]]
-            idx_counter += 1
+        :param list items: SQL tree
+        :return list: SQL tree without COUNT_COND, None if a COUNT_COND cannot be translated
+        """
 
-        join_where = create_join_string(table_2, table_1, self.schema, 'JOIN_WHERE')
+        def replace(macro):
+            table_1 = render(macro.args[0])
+            table_2 = render(macro.args[1])
 
-        if join_where is None:
-            logging.info(f'no join path found between {table_1} and {table_2}')
-            return False
+            if table_2 == table_1:
+                logging.warning('dropped query with aggregation over one table')
+                return None  # improper configuration of tables in COUNT_COND, ignore query
 
-        if join_where.count(' = ') > 1:
-            logging.info(f'need recursive JOIN for: {join_where}')
-            return False  # TODO adapt when longer paths are implemented
+            join_path = self.schema.join_paths.get((table_2, table_1))
 
-        join_1, join_2 = join_where.split(' = ')
+            if join_path is None:
+                logging.info(f'no join path found between {table_1} and {table_2}')
+                return None
 
-        new_sql = self.sql_tokens[0:i] + [join_1, "= ( SELECT", join_2, "FROM", table_1]
-        if cond:
-            new_sql += ['WHERE'] + cond
-        new_sql += ["GROUP BY", join_2, "ORDER BY count ( * ) desc limit 1"]
-        new_sql += self.sql_tokens[cond_start + idx_counter:]
+            join_1, join_2 = join_path.columns[0]
+            cond = join_args(macro.args[2:])
+            if len(join_path.tables) > 2:
+                # the join conditions would only bind to the first disjunct, and spider labels have no parentheses
+                if 'OR' in cond:
+                    logging.info(f'dropped query with OR condition over the join path {join_path.tables}')
+                    return None
+                # the subquery joins the tables after the first one along the path
+                cond = [' AND '.join(join_path.conditions[1:])] + (['AND'] + cond if cond else [])
+            new_items = [join_1, "= ( SELECT", join_2, "FROM", ' JOIN '.join(join_path.tables[1:])]
+            if cond:
+                new_items += ['WHERE'] + cond
+            new_items += ["GROUP BY", join_2, "ORDER BY count ( * ) desc limit 1", ")"]
 
-        self.sql_tokens = new_sql
+            return new_items
 
-        return self.translate_max_count()
+        return transform(items, {'COUNT_COND'}, replace)
 
-    def fill_in_join_cols(self):
+    def fill_in_join_cols(self, items):
         """
         resolve JOIN_COL by creating a Join over tables linked through a foreign key
 
-        :return bool: whether JOIN could be created
+        :param list items: SQL tree
+        :return list: SQL tree without JOIN_COL, None if a JOIN could not be created
         """
 
-        new_sql = []
-        i = 0
-        while i < len(self.sql_tokens):
-            if self.sql_tokens[i] == 'JOIN_COL':
-
-                ent1 = self.sql_tokens[i + 2]
-                ent2 = self.sql_tokens[i + 4]
-
-                join = join_col(ent1, ent2, self.schema)
-
-                if not join:
-                    return False
-
-                new_sql.append(join)
-                i += 5
+        def replace(macro):
+            join = join_col(render(macro.args[0]), render(macro.args[1]), self.schema)
+            return [join] if join else None
 
-            else:
-                new_sql.append(self.sql_tokens[i])
-
-            i += 1
-
-        self.sql_tokens = new_sql
-
-        return True
+        return transform(items, {'JOIN_COL'}, replace)
 
-    def fill_in_joins(self):
+    def fill_in_joins(self, items):
         """
+        resolve JOIN_WHERE and JOIN_FROM by the join conditions or joined tables of the linked tables
 
-        :return:
+        :param list items: SQL tree
+        :return list: SQL tree without JOIN_WHERE and JOIN_FROM, None if a JOIN could not be created
         """
 
-        i = 0
-        new_sql = []
-        while i < len(self.sql_tokens):
+        def replace(macro):
+            join = create_join_string(render(macro.args[0]), render(macro.args[1]), self.schema, macro.name)
+            return None if join is None else [join]
 
-            if self.sql_tokens[i] in ['JOIN_WHERE', 'JOIN_FROM']:
+        items = transform(items, {'JOIN_WHERE', 'JOIN_FROM'}, replace)
 
-                table1 = self.sql_tokens[i + 2]
-                table2 = self.sql_tokens[i + 4]
-
-                join = create_join_string(table1, table2, self.schema, self.sql_tokens[i])
-
-                if join is None:
-                    return False
-
-                new_sql.append(join)
-
-                i += 5
-                if join == '':
-                    if len(self.sql_tokens) > i + 1 and self.sql_tokens[i + 1] == 'AND':
-                        i += 2
-                        new_sql[-1] = self.sql_tokens[i]
-                    else:
-                        new_sql[-2:] = self.sql_tokens[i + 1:i + 3]
-                        i += 2
-            else:
-                new_sql.append(self.sql_tokens[i])
-
-            i += 1
-
-        self.sql_tokens = new_sql
-        return True
+        return None if items is None else drop_empty(items)
 
     def replace_values(self, database):
         """ replace literals placeholders in query with values from the database
@@ -656,9 +735,7 @@ class Query:
         :return bool: whether the query is valid on this DB
         """
 
-        sql = self.get_sql()
-        for type_string in sorted(self.schema.types, key=len, reverse=True):
-            sql = re.sub(f'{type_string}@\\d+', r'"placeholder"', sql)
+        sql = self.schema.re_placeholder.sub('"placeholder"', self.get_sql())
 
         # try to run sql
         db_path = glob.glob(self.parameters.db_dir + '/*.sqlite')[0]
@@ -676,59 +753,100 @@ class Query:
                     return False
         return True
 
-    def output_paraphrases(self, paraphraser, database, data, json_data):
+    def label_sql(self, database):
         """
-        create NL paraphrases and output samples to provided data structures
+        canonicalise and parse the SQL query and remove its values
 
-        :param paraphraser: PPDB paraphraser
         :param database: associated database object
-        :param data: list for samples
-        :param json_data: list for json formatted samples
+        :return SqlRecord: record shared by the paraphrases of the query, without label if the query cannot be parsed
         """
 
-        sql = self.get_sql()
-        if self.parameters.fill_literals:
-            sql = self.get_sql(filled=True)
-            paraphrases = paraphraser.get_paraphrases(self.nl_tokens_filled)
-        else:
-            paraphrases = paraphraser.get_paraphrases(self.nl_tokens)
-        if not self.parameters.no_canonical:
-            sql = make_canonical(sql, database.umich_schema, self.variables)
+        sql = self.get_sql(filled=self.parameters.fill_literals)
 
-        for type_string in sorted(self.schema.types, key=len, reverse=True):
-            sql = re.sub(f'{type_string}@\\d+', r'"value"', sql)
-        sql_label = sql.replace("'", '')
+        def canonicalise(query):
+            if not self.parameters.no_canonical:
+                query = make_canonical(query, database.umich_schema, self.variables)
+            return self.schema.re_placeholder.sub('"value"', query)
 
-        try:
-            sql_label = database.parse_query(sql_label)
-        except AssertionError:
+        # canonical form and label are shared by queries that only differ in their literals
+        key = (self.parameters.no_canonical, tuple(sorted(self.variables)))
+        sql, sql_label = database.canonical_cache.label(sql, key, canonicalise,
+                                                        lambda query: database.parse_query(query.replace("'", '')))
+        if sql_label is None:
+            sql_label = sql.replace("'", '')
             logging.error(f'could not create SQL label for {sql_label}')
             print(f'could not create SQL label for {sql_label}')
-            return
+            return SqlRecord(self.parameters.db, sql, None, None, None, None, self.variables)
 
         sql_no_values = sql
         for value in self.variables.values():
             sql_no_values = sql_no_values.replace(value, 'value')
-        sql_no_values = sql_no_values.replace('"value"', 'value')
-        sql_no_values = sql_no_values.replace('10', 'value')
+        sql_no_values = RE_NO_VALUE.sub('value', sql_no_values)
 
-        for p in paraphrases:
+        # the record and its SQL tokens are shared by all paraphrases and by equal queries of other lines
+        return database.sample_store.record(self.parameters.db, sql, sql_no_values, sql_label, self.variables)
+
+    def output_sql(self, database):
+        """
+        post-process the SQL query: translate templates, fill literals, validate, canonicalise and parse it
+
+        The SQL tokens of the query are replaced by the rendered query once its templates are translated.
+
+        :param database: associated database object
+        :return SqlRecord: output of label_sql, None if the query is dropped
+        """
+
+        items = self.translate_max_count(parse(self.sql_tokens))
+        if items is None:
+            return None
+
+        items = self.fill_in_join_cols(items)
+        if items is None:
+            return None
+
+        items = self.fill_in_joins(items)
+        if items is None:
+            return None
+
+        # argmax and argmin are translated when rendering
+        self.sql_tokens = render(items).split()
+
+        if self.parameters.fill_literals:
+            if not self.replace_values(database):
+                logging.warning('could not fill literals, aborting output')
+                return None
+
+        if self.parameters.validate:
+            if not self.valid():
+                logging.warning("invalid query, aborting output")
+                return None
 
-            for type_string in sorted(self.schema.types, key=len, reverse=True):
-                p = re.sub(f'{type_string}@\\d+', r'value', p)
+        return self.label_sql(database)
 
-            data.append((p, sql))
+    def output_paraphrases(self, paraphraser, sql_output, data, json_data):
+        """
+        create NL paraphrases and output samples to provided data structures
 
-            json_item = {'db_id': self.parameters.db,
-                         'query': sql,
-                         'query_no_value': sql_no_values,
-                         'query_toks': word_tokenize(sql),
-                         'query_toks_no_value': word_tokenize(sql_no_values),
-                         'question': p,
-                         'question_toks': word_tokenize(p),
-                         'sql': sql_label,
-                         'variables': self.variables}
-            json_data.append(json_item)
+        :param paraphraser: PPDB paraphraser
+        :param SqlRecord sql_output: output of label_sql
+        :param data: list for samples
+        :param json_data: list for samples as pairs of SqlRecord and question, see query.sample_store
+        """
+
+        if self.parameters.fill_literals:
+            paraphrases = paraphraser.get_paraphrases(self.nl_tokens_filled)
+        else:
+            paraphrases = paraphraser.get_paraphrases(self.nl_tokens)
+
+        if sql_output.sql is None:
+            return
+
+        for p in paraphrases:
+
+            p = self.schema.re_placeholder.sub('value', p)
+
+            data.append((p, sql_output.query))
+            json_data.append((sql_output, p))
 
     def output(self, paraphraser, database, data, json_data):
         """ post-processes and outputs query in which all slots have been filled
@@ -736,7 +854,7 @@ class Query:
         :param paraphraser: PPDB paraphraser
         :param database: associated database object
         :param data: list for output data
-        :param json_data: dict for json formatted output data
+        :param json_data: list for samples as pairs of SqlRecord and question
         """
 
         nl = self.get_nl()
@@ -748,28 +866,23 @@ class Query:
         assert nl.count('(') == nl.count(')'), f'uneven parentheses in NL query: {nl}'
         assert sql.count('(') == sql.count(')'), f'uneven parentheses in SQL query: {sql}'
 
-        if not self.translate_max_count():
-            return
+        if self.parameters.fill_literals:
+            # literals are drawn for every query
+            sql_output = self.output_sql(database)
+        else:
+            # the SQL side only depends on the SQL tokens, it is shared by the queries of a line with the same SQL
+            def compute():
+                sql_output = self.output_sql(database)
+                return tuple(self.sql_tokens), sql_output
 
-        if not self.fill_in_join_cols():
-            return
+            # the rendered SQL tokens are applied on every query, so it ends in the same state whether computed or not
+            sql_tokens, sql_output = database.sql_memo.get(self.sql_tokens, compute)
+            self.sql_tokens = list(sql_tokens)
 
-        if not self.fill_in_joins():
+        if sql_output is None:
             return
 
-        self.sql_tokens = translate_argmax_min(self.get_sql()).split()
-
-        if self.parameters.fill_literals:
-            if not self.replace_values(database):
-                logging.warning('could not fill literals, aborting output')
-                return
-
-        if self.parameters.validate:
-            if not self.valid():
-                logging.warning("invalid query, aborting output")
-                return
-
-        self.output_paraphrases(paraphraser, database, data, json_data)
+        self.output_paraphrases(paraphraser, sql_output, data, json_data)
 
     def __str__(self):
         return self.get_sql()
@@ -778,13 +891,18 @@ class Query:
         """
         custom deepcopy method; starting from a shallow copy
         leave immutable attributes (strings, numbers)
-        leave references to those, that do not differ for queries on the same DB (Database, Schema)
+        leave references to those, that do not differ for queries on the same DB (QueryContext)
         copy dicts/lists that change for each query (shallow copy since they contain strings)
 
         :param memo: list of copied objects
         :return Query: copied Query object
         """
-        new = copy(self)
+        new = Query.__new__(Query)
+
+        new.context = self.context
+        new.layer = self.layer
+        new.groupable = self.groupable
+        new.ent = self.ent
 
         new.nl_tokens = copy(self.nl_tokens)
         new.sql_tokens = copy(self.sql_tokens)
@@ -19,7 +19,6 @@ argCommandDict = {'argmax': '{functionToken.maxToken}', 'argmin': '{functionToke
 compSuperDict = pickle.load(open('../data/compsupadj.pickle', 'rb')) if 'data' not in os.listdir('.') else pickle.load(
     open('data/compsupadj.pickle', 'rb'))
 
-RE_ARG = re.compile(r'argmin \(|argmax \(')
 RE_SPECIAL_CHAR_SPACE = re.compile(r'([,!?()])')
 RE_APOSTROPHE = re.compile(r"'([a-zA-Z]+)\s")
 RE_FULL_STOP = re.compile(r'\.[$\s]')
@@ -107,70 +106,10 @@ def list_replace(str_list, original, substring, standalone):
     :param standalone: the replacement if replacing an entire list element
     """
 
-    for i in range(0, len(str_list)):
-        if original == str_list[i].strip():
-            str_list[i] = standalone
-        elif original in str_list[i]:
-            str_list[i] = str_list[i].replace(original, substring)
-
-
-def get_argmin_max_arguments(sql_string):
-    """
-    retrieves the arguments for the first argmin/argmax in the sql string as string
-
-    :param str sql_string: sql query
-    :return str: arguments for the first argmin/argmax
-    """
-
-    match = RE_ARG.search(sql_string)
-    if not match:
-        return None, None
-
-    arg_ops = 'MIN' if 'min' in match.group() else 'MAX'
-    parenthesis_open = 1
-    args = ""
-    for character in sql_string[match.end():]:
-        if character == '(':
-            parenthesis_open += 1
-        if character == ')':
-            parenthesis_open -= 1
-            if parenthesis_open < 1:
-                break
-        args += character
-
-    return args, arg_ops
-
-
-def translate_argmax_min(sql_string):
-    """
-    iteratively and recursively substitute all argmax/argmin templates
-
-    :param str sql_string: sql query
-    :return str: new sql query
-    """
-
-    sql_string = sql_string.replace('argmax(', 'argmax (')
-    sql_string = sql_string.replace('argmin(', 'argmin (')
-
-    while 'argmax' in sql_string or 'argmin' in sql_string:
-        (arg_parameters, arg_type) = get_argmin_max_arguments(sql_string)
-        match_split = arg_parameters.split(SEP)
-        assert len(match_split) > 2, f'not enough arguments for arg in query {sql_string}'
-        arg_column = match_split[0].strip()
-        arg_table = match_split[1].strip()
-        if len(match_split) == 3:
-            arg_where = match_split[2].strip()
-        else:
-            arg_where = SEP.join(match_split[2:])
-            arg_where = translate_argmax_min(arg_where)
-
-        arg_clause = f'{arg_column} = (SELECT {arg_type}({arg_column}) FROM {arg_table}'
-        arg_clause += (')' if arg_where == '' else f' WHERE {arg_where}) AND {arg_where} ')
-
-        to_replace = 'arg' + arg_type.lower() + ' (' + arg_parameters + ')'
-        sql_string = sql_string.replace(to_replace, arg_clause)
-
-    return sql_string
+    # a token equal to the original apart from whitespace contains it, so most tokens are skipped by one search
+    for i, token in enumerate(str_list):
+        if original in token:
+            str_list[i] = standalone if original == token.strip() else token.replace(original, substring)
 
 
 def simplify_sql(sql_string):
@@ -188,30 +127,9 @@ def simplify_sql(sql_string):
     return simple_sql_string
 
 
-def bfs_paths(graph, start, goal):
-    """
-    breadth first search to find connecting paths in a graph and return shortest first through a generator
-
-    :param dict graph: dictionary with nodes of the graph as keys and a list of directly connected nodes as values
-    :param str start: starting node
-    :param str goal: destination node
-    :return generator: list of connecting paths, shortest first
-    """
-
-    queue = [(start, [start])]
-
-    while queue:
-        (node, path) = queue.pop(0)
-        for next_node in set(graph[node]) - set(path):
-            if next_node == goal:
-                yield path + [next_node]
-            else:
-                queue.append((next_node, path + [next_node]))
-
-
 def create_join_string(table1, table2, schema, join_type):
     """
-    create join statement for two given tables
+    create join statement for two given tables, over the shortest path of foreign keys between them
 
     :param str table1: first table name
     :param str table2: second table name
@@ -229,59 +147,33 @@ def create_join_string(table1, table2, schema, join_type):
         else:
             return ''
 
-    # joins = []
-    # paths = bfs_paths(schema.links, table1, table2)
-    #
-    # best_p = next(paths, None)
-    # if not best_p:
-    #     return None
-    #
-    # if join_type == 'JOIN_FROM':
-    #     return ' JOIN '.join(best_p)
-    #
-    # for i in range(0, len(best_p) - 1):
-    #     joins.append(best_p[i] + '.' + schema.links[best_p[i]][best_p[i + 1]] + ' = ' + best_p[i + 1] + '.' +
-    #                  schema.links[best_p[i + 1]][best_p[i]])
-    #
-    # return ' AND '.join(joins)
-    if table2 in schema.links[table1]:
-        if join_type == 'JOIN_FROM':
-            return f'{table1} JOIN {table2}'
-        else:
-            return f'{table1}.{schema.links[table1][table2]} = {table2}.{schema.links[table2][table1]}'
-    else:
-        logging.info('No link found for JOIN with directly linked tables. Recursive JOIN not yet implemented')
+    join_path = schema.join_paths.get((table1, table2))
+    if join_path is None:
+        logging.info(f'no path of foreign keys between {table1} and {table2}')
         return None
 
+    return join_path.join_from if join_type == 'JOIN_FROM' else join_path.join_where
+
 
 def join_col(table1, table2, schema):
     """
-    create join
+    create join column of the first table linking it to the second table
+
+    JOIN_COL compares the linking columns of both tables, so the tables have to be linked directly
 
     :param str table1: first table name
     :param str table2: second table name
     :param schema: schema of the DB
-    :return:
+    :return str: column, None if the tables are not linked directly
     """
 
     if table1 == table2:
         logging.warning('attempted aggregation over one table')
         return None
 
-    # paths = bfs_paths(schema.links, table1, table2)
-    #
-    # best_p = next(paths, None)
-    # if not best_p:
-    #     return None
-    #
-    # if len(best_p) > 2:
-    #     logging.warning('No link found for JOIN with directly linked tables. Recursive JOIN not yet implemented')
-    #     return None
-    #
-    # return f'{best_p[0]}.{schema.links[best_p[0]][best_p[1]]}'
-
-    if table2 in schema.links[table1]:
-        return f'{table1}.{schema.links[table1][table2]}'
-    else:
-        logging.info('No link found for JOIN with directly linked tables. Recursive JOIN not yet implemented')
+    join_path = schema.join_paths.get((table1, table2))
+    if join_path is None or len(join_path.tables) > 2:
+        logging.info(f'no direct link between {table1} and {table2} for JOIN_COL')
         return None
+
+    return join_path.columns[0][0]
@@ -0,0 +1,141 @@
+# coding=utf-8
+""" compact storage of generated samples, expanded to the Spider json layout when they are output
+
+All paraphrases of a query share everything but their question, so a sample is a pair of a shared SqlRecord and a
+question. Question tokens are computed when the sample is expanded.
+"""
+import json
+from weakref import WeakValueDictionary
+
+from query.word_tokenizer import word_tokenize
+
+# json layout of the output files
+JSON_FORMAT = {'sort_keys': True, 'indent': 4, 'separators': (',', ': ')}
+
+# fields of a sample shared by its paraphrases
+RECORD_FIELDS = ('db_id', 'query', 'query_no_value', 'query_toks', 'query_toks_no_value', 'sql', 'variables')
+
+
+class SqlRecord:
+    """
+    fields of a sample that are shared by all paraphrases of a query; treated as immutable once created
+
+    Attributes:
+        str db_id: DB name
+        str query: SQL query
+        str query_no_value: SQL query with values replaced by value
+        tuple query_toks: tokens of the SQL query
+        tuple query_toks_no_value: tokens of the SQL query without values
+        dict sql: spider label of the SQL query, None if the query could not be parsed
+        dict variables: mapping from placeholders to literals
+    """
+
+    __slots__ = RECORD_FIELDS + ('__weakref__',)
+
+    def __init__(self, db_id, query, query_no_value, query_toks, query_toks_no_value, sql, variables):
+        self.db_id = db_id
+        self.query = query
+        self.query_no_value = query_no_value
+        self.query_toks = query_toks
+        self.query_toks_no_value = query_toks_no_value
+        self.sql = sql
+        self.variables = variables
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in RECORD_FIELDS)
+
+    def __setstate__(self, state):
+        for field, value in zip(RECORD_FIELDS, state):
+            setattr(self, field, value)
+
+
+class SampleStore:
+    """
+    interned SQL records of the samples generated for a DB
+
+    Records are held weakly, so records of samples that were streamed and dropped are freed.
+
+    Attributes:
+        WeakValueDictionary records: SqlRecord by DB, query and variables
+    """
+
+    def __init__(self):
+        self.records = WeakValueDictionary()
+
+    def record(self, db_id, query, query_no_value, sql, variables):
+        """
+        :param str db_id: DB name
+        :param str query: SQL query
+        :param str query_no_value: SQL query with values replaced by value
+        :param dict sql: spider label of the SQL query
+        :param dict variables: mapping from placeholders to literals
+        :return SqlRecord: the stored record of the query, created and tokenized if there is none
+        """
+        key = (db_id, query, tuple(sorted(variables.items())))
+        record = self.records.get(key)
+        if record is None:
+            record = SqlRecord(db_id, query, query_no_value, tuple(word_tokenize(query)),
+                               tuple(word_tokenize(query_no_value)), sql, dict(variables))
+            self.records[key] = record
+
+        return record
+
+
+def question_fields(question):
+    """
+    :param str question: NL question
+    :return dict: fields of a sample that belong to its question
+    """
+    return {'question': question, 'question_toks': word_tokenize(question)}
+
+
+def expand(sample):
+    """
+    :param tuple sample: SqlRecord and question
+    :return dict: sample in the Spider json layout
+    """
+    record, question = sample
+    fields = {field: getattr(record, field) for field in RECORD_FIELDS}
+    fields['query_toks'] = list(record.query_toks)
+    fields['query_toks_no_value'] = list(record.query_toks_no_value)
+    fields.update(question_fields(question))
+    return fields
+
+
+def json_entry(key, value):
+    """
+    :param str key: key of a sample
+    :param value: value of the key
+    :return str: the key and its value as json.dump writes them inside a list of samples
+    """
+    indent = ' ' * 2 * JSON_FORMAT['indent']
+    return indent + json.dumps(key) + ': ' + json.dumps(value, **JSON_FORMAT).replace('\n', '\n' + indent)
+
+
+def dump_samples(samples, open_file):
+    """
+    write samples like json.dump with JSON_FORMAT of their expanded list, rendering the fields of each record once
+
+    :param list samples: pairs of SqlRecord and question
+    :param open_file: file opened for writing
+    """
+    if not samples:
+        open_file.write('[]')
+        return
+
+    keys = sorted(RECORD_FIELDS + ('question', 'question_toks'))
+    # rendered entries by record, the records are kept so that their ids stay unique
+    rendered = {}
+    indent = ' ' * JSON_FORMAT['indent']
+    separator = '[\n'
+    for record, question in samples:
+        if id(record) not in rendered:
+            rendered[id(record)] = (record, {field: json_entry(field, getattr(record, field))
+                                             for field in RECORD_FIELDS})
+        entries = dict(rendered[id(record)][1])
+        entries.update((key, json_entry(key, value)) for key, value in question_fields(question).items())
+
+        text = ',\n'.join(entries[key] for key in keys)
+        open_file.write(f'{separator}{indent}{{\n{text}\n{indent}}}')
+        separator = ',\n'
+    open_file.write('\n]')
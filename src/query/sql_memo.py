@@ -0,0 +1,51 @@
+# coding=utf-8
+""" memo of the SQL side of output queries, shared by the queries of a template line with the same SQL
+"""
+
+
+class SqlMemo:
+    """
+    post-processed, validated, canonical and parsed SQL of the queries output for one template line
+
+    The NL templates of a line share their SQL template, and many fillings of NL slots leave the SQL unchanged, so
+    the SQL side of the output runs once per distinct SQL query of the line and is joined to every NL query with it.
+
+    Attributes:
+        dict entries: rendered SQL tokens and output of the SQL side (None if dropped) by SQL tokens
+        int lookups: number of queries output since the line started
+        int computed: number of queries whose SQL side was computed since the line started
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.lookups = 0
+        self.computed = 0
+
+    def start_line(self):
+        """
+        forget the SQL of the previous template line
+        """
+        self.entries.clear()
+        self.lookups = 0
+        self.computed = 0
+
+    def get(self, sql_tokens, compute):
+        """
+        :param list sql_tokens: SQL tokens of a query in which all slots have been filled
+        :param function compute: computes the SQL side of the query
+        :return: output of the SQL side
+        """
+        self.lookups += 1
+        key = tuple(sql_tokens)
+        if key not in self.entries:
+            self.computed += 1
+            self.entries[key] = compute()
+
+        return self.entries[key]
+
+    def statistics(self):
+        """
+        :return str: share of output queries that reused the SQL side of another query
+        """
+        shared = 1 - self.computed / self.lookups if self.lookups else 0.0
+        return f'SQL side computed for {self.computed} of {self.lookups} output queries, {shared:.1%} shared'
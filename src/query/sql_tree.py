@@ -0,0 +1,193 @@
+# coding=utf-8
+""" small syntax tree of SQL queries for the post-processing of generated queries
+
+A query is a list of items. An item is either a token or a Macro, a construct of the templates like
+argmax ( column $ table $ condition ), whose arguments are lists of items again. The tree is built once from the
+tokens of a query, the macros are rewritten by transforms and the query is rendered at the end.
+"""
+from query.query_utils import SEP
+
+# constructs of the templates that are rewritten before output, always followed by an opening parenthesis
+MACROS = {'COUNT_COND', 'JOIN_COL', 'JOIN_WHERE', 'JOIN_FROM', 'argmax', 'argmin'}
+
+# macros rendered as SQL
+ARG_MACROS = {'argmax', 'argmin'}
+
+
+class Macro:
+    """
+    template construct with arguments separated by $
+
+    Attributes:
+        str name: name of the construct, e.g. argmax
+        list args: arguments, each a list of items
+    """
+
+    def __init__(self, name, args):
+        """
+        :param str name: name of the construct
+        :param list args: arguments, each a list of items
+        """
+        self.name = name
+        self.args = args
+
+    def __repr__(self):
+        return f'{self.name} ( {" $ ".join(render(arg) for arg in self.args)} )'
+
+
+def parse(tokens):
+    """
+    build the tree of a tokenized SQL query in a single pass
+
+    :param list tokens: SQL tokens
+    :return list: items of the query
+    """
+
+    root = []
+    items = root
+    # open macros with the parenthesis depth of the enclosing argument
+    stack = []
+    depth = 0
+
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token in MACROS and i + 1 < len(tokens) and tokens[i + 1] == '(':
+            macro = Macro(token, [[]])
+            items.append(macro)
+            stack.append((macro, depth))
+            items = macro.args[-1]
+            depth = 0
+            i += 2
+            continue
+
+        if stack and depth == 0 and token == SEP:
+            macro = stack[-1][0]
+            macro.args.append([])
+            items = macro.args[-1]
+        elif stack and depth == 0 and token == ')':
+            depth = stack.pop()[1]
+            items = stack[-1][0].args[-1] if stack else root
+        else:
+            if token == '(':
+                depth += 1
+            elif token == ')':
+                depth -= 1
+            items.append(token)
+        i += 1
+
+    assert not stack, f'unclosed {stack[-1][0].name} in SQL query {" ".join(tokens)}'
+
+    return root
+
+
+def transform(items, names, replace):
+    """
+    replace macros in pre-order, the replacements are transformed as well
+
+    :param list items: items of a query or argument
+    :param set names: names of the macros to replace
+    :param function replace: maps a macro to the list of items replacing it, None if it cannot be replaced
+    :return list: new items, None if a macro could not be replaced
+    """
+
+    result = []
+    for item in items:
+        if isinstance(item, Macro):
+            if item.name in names:
+                replacement = replace(item)
+                if replacement is None:
+                    return None
+                replacement = transform(replacement, names, replace)
+                if replacement is None:
+                    return None
+                result.extend(replacement)
+                continue
+
+            args = []
+            for arg in item.args:
+                arg = transform(arg, names, replace)
+                if arg is None:
+                    return None
+                args.append(arg)
+            item = Macro(item.name, args)
+
+        result.append(item)
+
+    return result
+
+
+def join_args(args):
+    """
+    :param list args: arguments of a macro
+    :return list: items of the arguments separated by $
+    """
+
+    items = []
+    for i, arg in enumerate(args):
+        if i > 0:
+            items.append(SEP)
+        items.extend(arg)
+    return items
+
+
+def drop_empty(items):
+    """
+    remove empty tokens left by joins of a table with itself, together with the following AND or else the preceding
+    item
+
+    :param list items: items of a query or argument
+    :return list: new items
+    """
+
+    result = []
+    i = 0
+    while i < len(items):
+        item = items[i]
+        if isinstance(item, Macro):
+            result.append(Macro(item.name, [drop_empty(arg) for arg in item.args]))
+        elif item == '':
+            if i + 1 < len(items) and items[i + 1] == 'AND':
+                i += 1
+            elif result:
+                result.pop()
+        else:
+            result.append(item)
+        i += 1
+
+    return result
+
+
+def render_arg(macro):
+    """
+    translate argmax/argmin into a nested SELECT
+
+    :param Macro macro: argmax or argmin with column, table and optional conditions
+    :return str: SQL clause
+    """
+
+    assert macro.name in ARG_MACROS, f'{macro.name} was not resolved before rendering'
+    assert len(macro.args) > 2, f'not enough arguments for {macro.name}: {macro}'
+
+    arg_type = 'MIN' if macro.name == 'argmin' else 'MAX'
+    arg_column = render(macro.args[0]).strip()
+    arg_table = render(macro.args[1]).strip()
+    if len(macro.args) == 3 and not any(isinstance(item, Macro) for item in macro.args[2]):
+        arg_where = render(macro.args[2]).strip()
+    else:
+        # several conditions or nested macros are kept with the blank spaces around them
+        arg_where = SEP.join(f' {render(arg)} ' if arg else ' ' for arg in macro.args[2:])
+
+    arg_clause = f'{arg_column} = (SELECT {arg_type}({arg_column}) FROM {arg_table}'
+    arg_clause += (')' if arg_where == '' else f' WHERE {arg_where}) AND {arg_where} ')
+
+    return arg_clause
+
+
+def render(items):
+    """
+    :param list items: items of a query or argument
+    :return str: SQL with tokens separated by blank spaces
+    """
+
+    return ' '.join(item if isinstance(item, str) else render_arg(item) for item in items)
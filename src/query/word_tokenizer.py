@@ -0,0 +1,108 @@
+# coding=utf-8
+""" fast drop-in replacements for nltk's word_tokenize and the SQL tokenizer of spider's process_sql
+
+nltk splits the text into sentences with Punkt and runs about twenty regular expressions of the Treebank tokenizer
+over every sentence. On printable ASCII text without the constructs those steps treat context dependently, they
+reduce to a single regular expression and a few rules on its tokens, which word_tokenize applies. Everything else is
+handed to nltk, so the tokens are always the ones nltk produces.
+"""
+import re
+
+from nltk import word_tokenize as nltk_word_tokenize
+
+# characters the Treebank tokenizer separates wherever they occur
+RE_TOKEN = re.compile(r'''[()<>\[\]{}*;?!@#$%&"]|[:,](?!\d)|(?:[^ ()<>\[\]{}*;?!@#$%&":,]|[:,](?=\d))+''')
+
+# boundary of a token, as the Treebank tokenizer surrounds the separated characters with blank spaces
+BOUNDARY = r'''(?=[ ()<>\[\]{}*;?!@#$%&"]|[:,](?!\d)|$)'''
+
+# constructs handled by nltk: backticks, dashes, consecutive commas or colons, consecutive quotes, periods that may
+# end a sentence or precede closing brackets, ? and ! that may end a sentence before punctuation, and single quotes
+# that do not start a suffix like 's
+RE_NLTK_ONLY = re.compile(r'''`|--|[:,][:,]|""|[?!][^ =A-Za-z0-9_]'''
+                          r'''|\.(?<![A-Za-z0-9]\.)|\.(?![A-Za-z0-9]| *$)'''
+                          r"""|'(?<![A-Za-z0-9_]')|'(?!(?:[sSmMdD]|ll|LL|re|RE|ve|VE)?""" + BOUNDARY +
+                          r"""|(?<=[A-Za-z0-9_]n')t""" + BOUNDARY + r"""|(?<=[A-Za-z0-9_]N')T""" + BOUNDARY + r""")""")
+
+# words nltk splits into two tokens, searched in the lower case text
+RE_CONTRACTION = re.compile('cannot|gimme|gonna|gotta|lemme|wanna')
+
+# suffixes split from the end of a word
+RE_SUFFIX = re.compile(r"(?<=[^' ])(?:'[sSmMdD]?|'ll|'LL|'re|'RE|'ve|'VE|n't|N'T)$")
+
+# characters after which a double quote opens a quotation
+OPENING = ' ([{<'
+
+# string values of SQL queries, quotes are paired from the start of the query
+RE_VALUE = re.compile(r'"[^"]*"')
+
+# comparisons merged with a following =
+COMPARISON_PREFIX = ('!', '>', '<')
+
+
+def word_tokenize(text):
+    """
+    tokenize a text like nltk.word_tokenize
+
+    :param str text: text, e.g. an NL question or a SQL query
+    :return list: tokens
+    """
+    if not text.isascii() or not text.isprintable() or RE_NLTK_ONLY.search(text) or \
+            RE_CONTRACTION.search(text.lower()):
+        return nltk_word_tokenize(text)
+
+    tokens = []
+    for match in RE_TOKEN.finditer(text):
+        token = match.group()
+        if token == '"':
+            start = match.start()
+            tokens.append('``' if start == 0 or text[start - 1] in OPENING else "''")
+        elif "'" in token:
+            suffix = RE_SUFFIX.search(token)
+            if suffix and suffix.start() > 0:
+                tokens.append(token[:suffix.start()])
+                tokens.append(suffix.group())
+            else:
+                tokens.append(token)
+        else:
+            tokens.append(token)
+
+    # the final period of the text is a token
+    if tokens and len(tokens[-1]) > 1 and tokens[-1][-1] == '.':
+        tokens[-1:] = [tokens[-1][:-1], '.']
+
+    return tokens
+
+
+def tokenize_spider_sql(query):
+    """
+    tokenize a SQL query like process_sql.tokenize: lower case tokens, string values in double quotes, !=, >= and <=
+    merged into one token
+
+    :param str query: SQL query
+    :return list: tokens
+    """
+    query = str(query).replace("'", '"')
+    assert query.count('"') % 2 == 0, "Unexpected quote"
+
+    # string values are replaced by keys during tokenization, named by their positions like in process_sql
+    values = {}
+
+    def keep_value(match):
+        key = f'__val_{match.start()}_{match.end() - 1}__'
+        values[key] = match.group()
+        return key
+
+    tokens = [token.lower() for token in word_tokenize(RE_VALUE.sub(keep_value, query))]
+
+    merged = []
+    for i, token in enumerate(tokens):
+        if token == '=' and i > 0 and tokens[i - 1] in COMPARISON_PREFIX:
+            merged[-1] += '='
+        else:
+            merged.append(values.get(token, token))
+    # process_sql merges an = at the start with a comparison at the end
+    if merged and merged[0] == '=' and merged[-1] in COMPARISON_PREFIX:
+        merged = merged[:-1] + [merged[-1] + '='] + merged[1:]
+
+    return merged